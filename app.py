@@ -4,46 +4,218 @@ from dash.dependencies import Input, Output, State, Event
 from dash.exceptions import PreventUpdate
 import dash_html_components as html
 import dash_core_components as dcc
-import dash_table_experiments as dt
-from flask_caching import Cache
-import numpy as np
+from collections import OrderedDict
+from flask import Response, g, jsonify, request
+from flask_compress import Compress
+import functools
+import itertools
 import os
 import pandas as pd
-import plotly.graph_objs as go
+import redis
 import time
 import json
 
+from batch import batch_lookup, comparison_row, parse_handles
+import compact
+from datasets import DatasetStore
+from figures import (bar_figure, colors, comparison_figure, level_area_figure,
+                     toxicity_figure)
+from handle_store import HandleStore, merge_tweets
+from jobs import Jobs
+from lookup_cache import LookupCache
+from lookups import Lookups
+from metrics import registry, size_buckets
+from per_process import PerProcess
 from perspective import Perspective
+from pipeline import score_pages
+from quota import Quota, priority
+from score_cache import ScoreCache
+from scoring_service import ScoringService
+from single_flight import SingleFlight
 from twitter import Twitter
-
+from views import levels, make_views
+from wire import numbers, table_columns
+
+
+redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+redis_client = redis.StrictRedis.from_url(redis_url)
+registry.bind(redis_client)
+callback_seconds = registry.histogram('dash_callback_seconds',
+                                      'Time to run a dash callback')
+lookup_cache_requests = registry.counter('lookup_cache_requests_total',
+                                         'Handle lookups by cache result')
+response_bytes = registry.histogram('dash_response_bytes',
+                                    'Size of a dash callback response',
+                                    buckets=size_buckets)
+
+score_cache = ScoreCache(redis_client)
+handle_store = HandleStore(redis_client)
+datasets = DatasetStore(redis_client)
+lookups = Lookups(redis_client)
+jobs = Jobs(redis_client, lookups)
+flights = SingleFlight(redis_client)
+lookup_cache = LookupCache(redis_client)
+warm_top_n = int(os.environ.get('WARM_TOP_N', 20))
+# raise for deep history: storage and the table are paged, so only lookup
+# time and api budgets grow with it
+max_tweets = int(os.environ.get('MAX_TWEETS', 400))
+table_page_size = 10
+# most handles one batch may compare, since every one of them is a lookup
+# against the shared api budgets
+max_batch_handles = int(os.environ.get('MAX_BATCH_HANDLES', 200))
+# milliseconds between polls while a lookup or batch is running, and once
+# nothing is (just under the longest interval a browser timer allows)
+poll_interval = 1000
+idle_poll_interval = 2**31 - 1
+# budgets shared by every web and celery worker using the same keys
+perspective_qps = int(os.environ.get('PERSPECTIVE_QPS', 10))
+quotas = OrderedDict([
+    ('perspective', Quota(redis_client, 'perspective', perspective_qps, window=1)),
+    ('twitter:search', Quota(redis_client, 'twitter:search',
+                             int(os.environ.get('TWITTER_SEARCH_LIMIT', 450)),
+                             window=15*60)),
+])
 
 perspective_key = os.environ.get('PERSPECTIVE_KEY')
-perspective_client = Perspective(perspective_key)
-
 twitter_consumer_key = os.environ.get('TWITTER_KEY')
 twitter_consumer_secret = os.environ.get('TWITTER_SECRET')
-twitter_client = Twitter(twitter_consumer_key, twitter_consumer_secret)
+
+
+def make_perspective():
+    return Perspective(
+        perspective_key,
+        cache=score_cache,
+        qps=perspective_qps,
+        max_in_flight=int(os.environ.get('PERSPECTIVE_MAX_IN_FLIGHT', 20)),
+        service=ScoringService(),
+        dedup_threshold=float(os.environ.get('DEDUP_THRESHOLD', 0.8)),
+        quota=quotas['perspective'])
+
+
+def make_twitter():
+    return Twitter(twitter_consumer_key, twitter_consumer_secret,
+                   slices=int(os.environ.get('TWITTER_SLICES', 1)),
+                   quota=quotas['twitter:search'])
+
+
+# built in whichever process first runs a lookup (normally a celery
+# worker), never at import, so preloaded web workers don't share sockets
+perspective_client = PerProcess(make_perspective)
+twitter_client = PerProcess(make_twitter)
 
 app = dash.Dash('harassment dashboard')
 server = app.server
-CACHE_CONFIG = {
-    'CACHE_TYPE': 'redis',
-    'CACHE_REDIS_URL': os.environ.get('REDIS_URL', 'localhost:6379')
-}
-cache = Cache()
-cache.init_app(app.server, config=CACHE_CONFIG)
+
+
+def is_callback():
+    return request.path.endswith('/_dash-update-component')
+
+
+# after_request hooks run last registered first, so observe_sent runs
+# after flask_compress has gzipped the response and observe_json before
+@server.after_request
+def observe_sent(response):
+    """
+    Observe a callback response's size as json and as sent, and add both
+    to the totals of the dataset it was drawn from
+    """
+    if not is_callback() or 'json_bytes' not in g:
+        return response
+    body = request.get_json(silent=True) or {}
+    output = (body.get('output') or {}).get('id', 'unknown')
+    sent_bytes = len(response.get_data())
+    response_bytes.observe(g.json_bytes, output=output, encoding='json')
+    response_bytes.observe(sent_bytes, output=output,
+                           encoding=response.headers.get('Content-Encoding', 'identity'))
+    dataset_key = next((item.get('value') for item in
+                        (body.get('inputs') or []) + (body.get('state') or [])
+                        if item.get('id') == 'signal'), None)
+    if dataset_key:
+        datasets.add_sent(dataset_key, g.json_bytes, sent_bytes)
+    return response
+
+
+Compress(server)
+
+
+@server.after_request
+def observe_json(response):
+    if is_callback():
+        g.json_bytes = len(response.get_data())
+    return response
+
+
+@server.route('/stats/score-cache')
+def score_cache_stats():
+    """
+    Perspective score cache hit/miss counts, used to size the cache
+    """
+    return jsonify(score_cache.stats())
+
+
+@server.route('/metrics')
+def metrics():
+    """
+    Pipeline metrics from every worker, in prometheus text format
+    """
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@server.route('/stats/payload/<path:dataset_key>')
+def payload_stats(dataset_key):
+    """
+    Bytes of callback responses drawn from a dataset, i.e. what one lookup
+    has cost the browsers showing it, as json and as sent
+    """
+    return jsonify(datasets.sent(dataset_key))
+
+
+@server.route('/stats/quota')
+def quota_stats():
+    """
+    API calls used in the current window of each shared quota
+    """
+    return jsonify({name: quota.usage() for name, quota in quotas.items()})
+
+
+@server.route('/api/batch', methods=['POST'])
+def batch_api():
+    """
+    Queue a comparison of several handles, given as json
+    {"handles": ["@a", "@b", ...]} or a whitespace separated string
+    """
+    body = request.get_json(force=True, silent=True)
+    if not isinstance(body, dict):
+        return jsonify({'error': 'expected a json object'}), 400
+    handles = body.get('handles', [])
+    if isinstance(handles, list) and all(isinstance(h, str) for h in handles):
+        handles = ' '.join(handles)
+    if not isinstance(handles, str):
+        return jsonify({'error': 'handles must be a string or a list of strings'}), 400
+    handles = parse_handles(handles)
+    if not handles:
+        return jsonify({'error': 'no handles'}), 400
+    if len(handles) > max_batch_handles:
+        return jsonify({'error': f'at most {max_batch_handles} handles'}), 400
+    return jsonify({'job_id': jobs.submit_batch(handles), 'handles': handles})
+
+
+@server.route('/api/batch/<job_id>')
+def batch_status(job_id):
+    """
+    Status of a comparison and the per-handle level counts so far
+    """
+    job = jobs.get(job_id)
+    if 'handles' not in job:
+        return jsonify({'error': 'unknown batch job'}), 404
+    return jsonify({'state': job['state'],
+                    'handles': json.loads(job['handles']),
+                    'completed': int(job['completed']),
+                    'comparison': json.loads(job.get('comparison', '{}'))})
 
 app.css.append_css({"external_url": "https://codepen.io/chriddyp/pen/bWLwgP.css"})
 app.css.append_css({"external_url": "https://codepen.io/prometheusred/pen/MVbJvO.css"})
 
-colors = {
-    'background': 'white',
-    'text': 'black',
-    'high': '#D400F9',
-    'medium': '#6d60fe',
-    'low': '#25C1F9',
-}
-
 explanation = "This dashboard visualizes toxic language in Tweets and offers a way to engage to help the harassed.  Just enter someone's twitter handle to see if they are the target of toxicity and harassment."
 
 center_el = {'width': '600px',
@@ -127,12 +299,33 @@ app.layout = html.Div([
             #     id='datatable'
             # ), style={'margin': '10px auto'})
 
-            html.Div(id='table-container', style={'margin': '0 50px 0 50px', 'minWidth': '650px'})
+            html.Div(children=[
+
+                html.Div(children=[
+                    dcc.Dropdown(id='table-level',
+                                 options=[{'label': level, 'value': level}
+                                          for level in levels],
+                                 placeholder='toxicity level',
+                                 style={'width': '160px'}),
+                    dcc.Dropdown(id='table-sort',
+                                 options=[{'label': 'newest first', 'value': 'newest'},
+                                          {'label': 'most toxic first', 'value': 'toxicity'}],
+                                 value='newest',
+                                 clearable=False,
+                                 style={'width': '180px'}),
+                    html.Label(children='page'),
+                    dcc.Input(id='table-page', type='number', min=1, value=1,
+                              style={'width': '70px'})],
+                         style={'display': 'flex', 'alignItems': 'center'}),
+
+                html.Div(id='table-container')],
+
+                     style={'margin': '0 50px 0 50px', 'minWidth': '650px'})
 
         ],
                  style=top_container),
 
-        #dcc.Graph(id='toxicity-area', style={'margin': '100px 10px 100px 10px'}),
+        dcc.Graph(id='toxicity-area', style={'margin': '100px 10px 100px 10px'}),
 
         html.H2(children='Toxicity over time',
                 style={'margin': '120px 0 12px', 'textAlign': 'center'}),
@@ -159,8 +352,33 @@ app.layout = html.Div([
 
     ]),
 
+    html.H2(children='Compare handles',
+            style={'margin': '120px 0 12px', 'textAlign': 'center'}),
+
+    html.P(children='(enter a list of handles to compare toxicity levels)',
+           style={'margin': '0 0 20px', 'textAlign': 'center'}),
+
+    html.Div(children=[
+
+        dcc.Textarea(id='batch-input',
+                     placeholder='@handle1 @handle2 ...',
+                     style={'width': '500px', 'height': '80px'}),
+
+        html.Button('Compare',
+                    id='batch-button', style=right_el),],
+
+             style=center_container),
+
+    dcc.Graph(id='comparison-bar', style={'margin': '20px 50px'}),
+
+    html.Div(id='batch-job', style={'display': 'none'}),
+
+    html.Div(id='lookup', style={'display': 'none'}),
+
     html.Div(id='signal', style={'display': 'none'}),
 
+    dcc.Interval(id='poll', interval=idle_poll_interval),
+
 ], style={'color': 'black',
           'left': 0,
           'top': 0,
@@ -171,32 +389,73 @@ app.layout = html.Div([
           'backgroundColor': colors['background']})
 
 
-@app.callback(Output('signal', 'children'),
+@app.callback(Output('lookup', 'children'),
               [Input('submit-button', 'n_clicks')],
                state=[State('input-box', 'value')])
+@callback_seconds.timed(callback='request_scores')
 def request_scores(n_clicks, input_value):
     """
     Initiates tweet -> score lookup when clicking submit
-    Will look for the @handle in redis before starting
-    request process.  Data is signaled through invisible div
-    so that it can be used for multiple visualizations without
-    blocking or doing weird things with state.
+    The lookup is queued as a background job that publishes its
+    results page by page; the job id and handle are signaled through
+    invisible div so poll_scores knows what to look for.
     """
     if n_clicks:
         print('request_scores')
-        try:
-            return global_store(input_value).to_json(date_format='iso',
-                                                 orient='split')
-        except Exception as e:
-            print('**ERROR**')
-            print(e)
-            print(input_value)
+        job_id = jobs.submit(input_value)
+        return json.dumps({'job_id': job_id, 'handle': input_value})
+
+
+@app.callback(Output('poll', 'interval'),
+              [Input('poll', 'n_intervals'),
+               Input('lookup', 'children'),
+               Input('batch-job', 'children')],
+              state=[State('poll', 'interval')])
+@callback_seconds.timed(callback='poll_rate')
+def poll_rate(n_intervals, lookup, batch_job, interval):
+    """
+    Poll every second while this tab's lookup or batch is running, and
+    practically stop once they have finished, so idle tabs don't keep
+    hitting the server
+    """
+    job_ids = [json.loads(lookup)['job_id']] if lookup else []
+    if batch_job:
+        job_ids.append(batch_job)
+    wanted = poll_interval if jobs.active(job_ids) else idle_poll_interval
+    if wanted == interval:
+        raise PreventUpdate('interval unchanged')
+    return wanted
+
+
+@app.callback(Output('signal', 'children'),
+              [Input('poll', 'n_intervals'),
+               Input('lookup', 'children')],
+              state=[State('signal', 'children')])
+@callback_seconds.timed(callback='poll_scores')
+def poll_scores(n_intervals, lookup, dataset_key):
+    """
+    Signal the latest published results for the job being polled.
+    Only the dataset key is signaled through invisible div so that it
+    can be used for multiple visualizations without blocking or doing
+    weird things with state.  An empty string signals no tweets.
+    """
+    if not lookup:
+        raise PreventUpdate('no lookup yet!')
+    status = jobs.status(json.loads(lookup)['job_id'])
+    if status.get('state') in ('empty', 'error'):
+        latest = ''
+    else:
+        latest = status.get('dataset')
+    if latest is None or latest == dataset_key:
+        raise PreventUpdate('nothing new')
+    return latest
 
 
 @app.callback(Output('input-box', 'value'),
-              [Input('signal', 'children')],
+              [Input('lookup', 'children')],
                state=[State('input-box', 'value')])
-def reset(tweets, input_value):
+@callback_seconds.timed(callback='reset')
+def reset(handle, input_value):
     """
     Clear input box after user clicks submit.
     """
@@ -207,6 +466,7 @@ def reset(tweets, input_value):
 @app.callback(Output('toggle', 'style'),
               [Input('submit-button', 'n_clicks')],
               state=[State('input-box', 'value')])
+@callback_seconds.timed(callback='toggle_graphs')
 def toggle_graphs(n_clicks, value):
     """
     show graphs after first submission
@@ -218,17 +478,17 @@ def toggle_graphs(n_clicks, value):
 
 
 @app.callback(Output('warning', 'style'),
-              [Input('submit-button', 'n_clicks'),
-               Input('signal', 'children')])
-def toggle_warning(n_clicks, signal):
+              [Input('signal', 'children')])
+@callback_seconds.timed(callback='toggle_warning')
+def toggle_warning(signal):
     """
     displays warning message if twitter handle returns 0 tweets
     or errors.
     """
-    if signal or n_clicks <= 0:
-        return {'display': 'none'}
-    else:
+    if signal == '':
         return warning
+    else:
+        return {'display': 'none'}
 
 # @app.callback(Output('join-link', 'children'),
 #               [Input('submit-button', 'n_clicks')],
@@ -244,19 +504,43 @@ def toggle_warning(n_clicks, signal):
 #                   href='https://twitter.com/' + value[1:len(value)])
 
 
+def clicked_tweet(clickData, dataset_key, need_full_text=False):
+    """
+    Details of the tweet clicked in the toxicity graph, from the point's
+    customdata (see figures.toxicity_figure).  The dataset is only read for
+    text longer than the figure carries, or for figures drawn without
+    customdata.
+
+    Returns:
+        tuple: (screen name, status id, text)
+    """
+    point = clickData['points'][0]
+    customdata = point.get('customdata')
+    if customdata and not (need_full_text and customdata[3]):
+        tweeter, tweet_id, text, _ = customdata
+        return tweeter, tweet_id, text
+    if not dataset_key:
+        raise PreventUpdate('no data yet!')
+    columns = datasets.get_columns(dataset_key,
+                                   ['screen_name', 'id_str', 'full_text'],
+                                   rows=[point['x'] - 1])
+    if columns is None:
+        raise PreventUpdate('dataset expired')
+    return (columns['screen_name'][0], columns['id_str'][0],
+            columns['full_text'][0])
+
+
 @app.callback(Output('join-link', 'children'),
-              [Input('toxicity-over-time', 'clickData'),
-               Input('signal', 'children')])
-def make_link_specific(clickData, tweets_json):
+              [Input('toxicity-over-time', 'clickData')],
+              state=[State('signal', 'children')])
+@callback_seconds.timed(callback='make_link_specific')
+def make_link_specific(clickData, dataset_key):
     """
     Create a link to tweeter's twitter profile
     """
-    if not tweets_json or not clickData:
+    if not clickData:
         raise PreventUpdate('no data yet!')
-    tweets_df = pd.read_json(tweets_json, orient='split')
-    clicked_index = clickData['points'][0]['x'] - 1
-    tweet_id = tweets_df.iloc[clicked_index].get('id_str')
-    tweeter = tweets_df.iloc[clicked_index]['user'].get('screen_name')
+    tweeter, tweet_id, _ = clicked_tweet(clickData, dataset_key)
     link = f"https://twitter.com/{tweeter}/status/{tweet_id}"
     return html.A(html.Button(children=['Join the conversation!']),
                   href=link,
@@ -264,18 +548,17 @@ def make_link_specific(clickData, tweets_json):
 
 
 @app.callback(Output('full-text', 'children'),
-              [Input('toxicity-over-time', 'clickData'),
-               Input('signal', 'children')])
-def show_tweet(clickData, tweets_json):
+              [Input('toxicity-over-time', 'clickData')],
+              state=[State('signal', 'children')])
+@callback_seconds.timed(callback='show_tweet')
+def show_tweet(clickData, dataset_key):
     """
     Create text box to show tweet on hover
     """
-    if not tweets_json or not clickData:
+    if not clickData:
         raise PreventUpdate('no data yet!')
-    tweets_df = pd.read_json(tweets_json, orient='split')
-    click_index = clickData['points'][0]['x'] - 1
-    full_text = tweets_df.iloc[click_index]['full_text']
-    tweeter = tweets_df.iloc[click_index]['user'].get('screen_name')
+    tweeter, _, full_text = clicked_tweet(clickData, dataset_key,
+                                          need_full_text=True)
     output_string = '**{}**: {}'.format(tweeter, full_text)
     return dcc.Markdown(output_string)
 
@@ -308,46 +591,83 @@ make_table using dash/react component
 #     return new_df.to_dict('records')
 
 
+@app.callback(Output('table-level', 'value'),
+              [Input('toxicity-bar', 'clickData')])
+@callback_seconds.timed(callback='select_level')
+def select_level(clickData):
+    """
+    clicking a bar in the bar chart shows that level's tweets in the table
+    """
+    if not clickData:
+        raise PreventUpdate('no data yet!')
+    return clickData['points'][0]['x']
+
+
+@app.callback(Output('table-page', 'value'),
+              [Input('table-level', 'value'),
+               Input('table-sort', 'value')])
+@callback_seconds.timed(callback='first_page')
+def first_page(level, sort):
+    """
+    go back to the first page of the table when its rows change
+    """
+    return 1
+
+
 '''
 make_table using html/css
 '''
 @app.callback(Output('table-container', 'children'),
-              [Input('toxicity-bar', 'clickData'),
+              [Input('table-level', 'value'),
+               Input('table-sort', 'value'),
+               Input('table-page', 'value'),
                Input('signal', 'children')])
-def make_table(clickData, tweets_json):
+@callback_seconds.timed(callback='make_table')
+def make_table(level, sort, page, dataset_key):
     """
-    filter table data according to toxicity level clicked on in bar chart
+    One page of the tweets at a toxicity level, newest or most toxic first.
+    Only the rows on the page are loaded from the dataset store.
     """
-    print('make_table')
-    if not tweets_json or not clickData:
+    if not dataset_key or not level:
         raise PreventUpdate('no data yet!')
-    tweets_df = pd.read_json(tweets_json, orient='split')
-    clicked_tox_level = clickData['points'][0]['x']
-    if clicked_tox_level == 'Low':
-        df = tweets_df[tweets_df['LOW_LEVEL'] == True]
-    elif clicked_tox_level == 'Medium':
-        df = tweets_df[tweets_df['MED_LEVEL'] == True]
-    elif clicked_tox_level == 'High':
-        df = tweets_df[tweets_df['HI_LEVEL'] == True]
-
-    new_df = pd.DataFrame()
-
-    #failed attempt to get full text into a link instead of just author
-    #new_df['text'] = df['full_text'] #.apply(text_to_link, axis=1)
-    # links = []
-    # for index, row in df.iterrows():
-    #     tweet_id = row.get('id_str')
-    #     tweeter = row['user'].get('screen_name')
-    #     l = f"https://twitter.com/{tweeter}/status/{tweet_id}"
-    #     link = html.A(row['full_text'], href=l, target='_blank')
-    #     links.append(link)
-
-    new_df['text'] = df['full_text']
-    new_df['author'] = df['screen_name'].apply(text_to_link)
-    #new_df['author'] = df['screen_name']
-    new_df['time'] = df['display_time']
-    new_df['toxicity'] = df['TOXICITY_score']
-    return generate_table(new_df)
+    try:
+        page = int(page or 1)
+    except ValueError:
+        raise PreventUpdate('not a page number')
+    return table_page(dataset_key, level, sort, page)
+
+
+@functools.lru_cache(maxsize=256)
+def table_page(dataset_key, level, sort, page):
+    """
+    Rendered table page, cached per worker: a dataset key names one result,
+    so a page never changes once rendered.  Expired datasets raise instead
+    of returning, so they are not cached.
+    """
+    views = datasets.get_views(dataset_key)
+    if views is None:
+        raise PreventUpdate('dataset expired')
+
+    # row indexes per level, in both orders, are built with the views
+    if sort == 'toxicity':
+        rows = views['level_rows_by_toxicity'][level]
+    else:
+        rows = views['level_rows'][level]
+    pages = max(1, -(-len(rows) // table_page_size))
+    page = min(max(page, 1), pages)
+    page_rows = rows[(page - 1) * table_page_size:page * table_page_size]
+
+    columns = datasets.get_columns(dataset_key, list(table_columns.values()),
+                                   rows=page_rows)
+    if columns is None:
+        raise PreventUpdate('dataset expired')
+    cells = OrderedDict((header, columns[col].tolist())
+                        for header, col in table_columns.items())
+    cells['author'] = [text_to_link(name) for name in cells['author']]
+    cells['toxicity'] = numbers(columns[table_columns['toxicity']])
+
+    return [generate_table(cells, max_rows=table_page_size),
+            html.P(children=f"page {page} of {pages} ({len(rows)} tweets)")]
 
 def text_to_link(name):
     """
@@ -361,201 +681,322 @@ def text_to_link(name):
     return html.A(html.P(children=[name]), href=link, target='_blank')
     #return html.A('blah', href=link, target='_blank')
 
-def generate_table(dataframe, max_rows=10):
+def generate_table(columns, max_rows=10):
+    """
+    Args:
+        columns(OrderedDict): header -> list of cell values, all the same length
+    """
     return html.Table(
         # Header
-        [html.Tr([html.Th(col) for col in dataframe.columns])] +
+        [html.Tr([html.Th(col) for col in columns])] +
 
         # Body
-        [html.Tr([
-            html.Td(dataframe.iloc[i][col]) for col in dataframe.columns
-        ]) for i in range(min(len(dataframe), max_rows))],
+        [html.Tr([html.Td(cell) for cell in row])
+         for row in itertools.islice(zip(*columns.values()), max_rows)],
     )
 
 
 @app.callback(Output('toxicity-bar', 'figure'),
               [Input('signal', 'children')],
-              state=[State('input-box', 'value')])
-def update_bar(tweets_json, handle):
+              state=[State('lookup', 'children')])
+@callback_seconds.timed(callback='update_bar')
+def update_bar(dataset_key, lookup):
     """
     Pull data from signal and updates aggregate bar graph
 
     This is using thresholds that combine toxicity and severe toxicity models
     suggested by Lucas.
     """
-    if not tweets_json:
+    if not dataset_key:
         raise PreventUpdate('no data yet!')
 
-    tweets_df = pd.read_json(tweets_json, orient='split')
-
-    low_count = tweets_df['LOW_LEVEL'].value_counts().get(True, 0)
-    med_count = tweets_df['MED_LEVEL'].value_counts().get(True, 0)
-    hi_count = tweets_df['HI_LEVEL'].value_counts().get(True, 0)
-    begin_date = tweets_df['display_time'].iloc[-1]
-    end_date = tweets_df['display_time'].iloc[0]
-    title = f"tweets at {handle}: {begin_date}  –  {end_date} (UTC)"
-
-    data = dict(
-        type='bar',
-        x=['Low', 'Medium', 'High'],
-        y=[low_count, med_count, hi_count],
-        marker=dict(
-            color=[colors['low'],
-                   colors['medium'],
-                   colors['high']])
-    )
+    views = datasets.get_views(dataset_key)
+    if views is None:
+        raise PreventUpdate('dataset expired')
 
-    return {
-        'data': [data],
-        'layout': dict(
-            type='layout',
-            title=title,
-            xaxis={'title': 'toxicity level'},
-            yaxis={'title': 'count'},
-        )
-    }
+    return bar_figure(views, json.loads(lookup)['handle'])
 
-'''
-TODO: stacked area chart with buckets of < 10 tweets
-'''
+@app.callback(Output('toxicity-area', 'figure'),
+              [Input('signal', 'children'),
+               Input('toxicity-area', 'relayoutData')],
+              state=[State('lookup', 'children'),
+                     State('toxicity-area', 'figure')])
+@callback_seconds.timed(callback='update_area')
+def update_area(dataset_key, relayout_data, lookup, figure):
+    """
+    Stacked area chart of toxicity levels over time, re-bucketed to the
+    visible time range when zoomed
+    """
+    if not dataset_key:
+        raise PreventUpdate('no data yet!')
+    views = datasets.get_views(dataset_key)
+    if views is None or 'created' not in views:
+        raise PreventUpdate('dataset expired')
 
-# @app.callback(Output('toxicity-area', 'figure'),
-#               [Input('signal', 'children')],
-#                state=[State('input-box', 'value')])
-# def update_area(tweets_json, handle):
-#     """
-#     Pulls data from signal and updates area chart
-#     """
-#     if not tweets_json:
-#         raise PreventUpdate('no data yet!')
-#     tweets_df = pd.read_json(tweets_json, orient='split')
+    x_range = zoomed_range(relayout_data, figure, dataset_key)
+    time_range = None
+    if x_range is not None:
+        time_range = tuple(pd.Timestamp(t).value / 1e9 for t in x_range)
+    area = level_area_figure(views, json.loads(lookup)['handle'], time_range)
+    area['layout']['datarevision'] = dataset_key
+    return area
 
-#     x = list(range(1, len(tweets_df) + 1))
-
-#     step = int(len(tweets_df) / BIN_SIZE)
-#     stop = len(tweets_df) + step
-#     labels = range(0, stop, step)
-
-#     #low_toxicity = tweets_df[]
-
-
-#     low_trace = dict(
-#         type='scatter',
-#         name='low',
-#         x=x,
-#         y=low_count,
-#         text=low_count,
-#         mode='lines',
-#         fill='tonexty',
-#     )
-#     med_trace = dict(
-#         type='scatter',
-#         name='medium',
-#         x=x,
-#         y=low_count + med_count,
-#         text=med_count,
-#         mode='lines',
-#         fill='tonexty',
-#     )
-#     hi_trace = dict(
-#         type='scatter',
-#         name='high',
-#         x=x,
-#         y=low_count + med_count + hi_count,
-#         text=hi_count,
-#         mode='lines',
-#         fill='tonexty',
-#     )
-
-
-#     return {
-#         'data': [low_trace, med_trace, hi_trace],
-#         'layout': dict(
-#             type='layout',
-#             title='Cumulative toxicity levels over time',
-#             showLegend=True,
-#             yaxis=dict(
-#                 type='linear',
-#                 range=[1, 100],
-#                 dtick=20,
-#             )
-#         )
-#     }
-
-#     layout = go.Layout(
-#     showlegend=True,
-#     xaxis=dict(
-#         type='category',
-#     ),
-#     yaxis=dict(
-#         type='linear',
-#         range=[1, 100],
-#         dtick=20,
-#         ticksuffix='%'
-#     )
-# )
+
+def zoomed_range(relayout_data, figure, dataset_key):
+    """
+    The x axis range a graph was zoomed to, if its figure still shows
+    dataset_key; None to draw everything.  Relayouts that don't change the
+    x axis (e.g. zooming only the y axis) don't update the figure.
+    """
+    if not figure or figure['layout'].get('datarevision') != dataset_key:
+        # new data, any zoom was on the previous dataset
+        return None
+    relayout_data = relayout_data or {}
+    if relayout_data.get('xaxis.autorange'):
+        return None
+    if 'xaxis.range[0]' in relayout_data:
+        return relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']
+    if 'xaxis.range' in relayout_data:
+        return tuple(relayout_data['xaxis.range'])
+    raise PreventUpdate('x axis unchanged')
 
 
 @app.callback(Output('toxicity-over-time', 'figure'),
-              [Input('signal', 'children')],
-               state=[State('input-box', 'value')])
-def update_graph(tweets_json, handle):
+              [Input('signal', 'children'),
+               Input('toxicity-over-time', 'relayoutData')],
+               state=[State('lookup', 'children'),
+                      State('toxicity-over-time', 'figure')])
+@callback_seconds.timed(callback='update_graph')
+def update_graph(dataset_key, relayout_data, lookup, figure):
     """
-    Pulls data from signal and updates graph
+    Pulls data from signal and updates graph, downsampling the visible
+    range again when zoomed
 
     Args:
-        tweets_json(json): the data for a given @handle
+        dataset_key(str): key of the data for a given @handle in the dataset store
+        relayout_data(dict): the graph's last zoom or pan
 
     Returns: dictionary that defines line/scatter graph with given data
     """
-    if not tweets_json:
+    if not dataset_key:
         raise PreventUpdate('no data yet!')
-    tweets_df = pd.read_json(tweets_json, orient='split')
-    x = list(range(1, len(tweets_df) + 1))
-
-    toxicity_trace = dict(
-        x=x,
-        y=tweets_df['TOXICITY_score'],
-        mode='lines',
-        fill='tonexty',
-        name='toxicity',
-        line=dict(width=0.5,
-                 color='rgb(111, 200, 219)'),
-        type='scatter'
-    )
+    views = datasets.get_views(dataset_key)
+    if views is None:
+        raise PreventUpdate('dataset expired')
+    x_range = zoomed_range(relayout_data, figure, dataset_key)
+    graph = toxicity_figure(views, json.loads(lookup)['handle'], x_range,
+                            points=functools.partial(datasets.get_points, dataset_key))
+    graph['layout']['datarevision'] = dataset_key
+    return graph
+
+
+@app.callback(Output('batch-job', 'children'),
+              [Input('batch-button', 'n_clicks')],
+              state=[State('batch-input', 'value')])
+@callback_seconds.timed(callback='request_batch')
+def request_batch(n_clicks, handles):
+    """
+    Queue a comparison of the handles entered in the batch box
+    """
+    handles = parse_handles(handles or '')
+    if not n_clicks or not handles:
+        raise PreventUpdate('no handles yet!')
+    if len(handles) > max_batch_handles:
+        print(f"batch of {len(handles)} handles cut to {max_batch_handles}")
+    return jobs.submit_batch(handles[:max_batch_handles])
+
+
+@app.callback(Output('comparison-bar', 'figure'),
+              [Input('poll', 'n_intervals'),
+               Input('batch-job', 'children')],
+              state=[State('comparison-bar', 'figure')])
+@callback_seconds.timed(callback='update_comparison')
+def update_comparison(n_intervals, job_id, figure):
+    """
+    Redraw the comparison as handles in the batch finish
+    """
+    if not job_id:
+        raise PreventUpdate('no batch yet!')
+    job = jobs.get(job_id)
+    comparison = json.loads(job.get('comparison', '{}'), object_pairs_hook=OrderedDict)
+    new_figure = comparison_figure(comparison)
+    if figure and figure.get('layout', {}).get('title') == new_figure['layout']['title']:
+        raise PreventUpdate('nothing new')
+    return new_figure
+
+
+def run_batch(handles, job_id):
+    """
+    Run a comparison job (on a celery worker, see jobs.py), reusing cached
+    lookups and publishing each handle's level counts as it finishes.
+    """
+    jobs.update(job_id, state='running')
+    comparison = OrderedDict()
+
+    def publish(handle, stored):
+        comparison[handle] = comparison_row(stored)
+        in_order = OrderedDict((h, comparison[h]) for h in handles if h in comparison)
+        jobs.update(job_id, completed=len(comparison),
+                    comparison=json.dumps(in_order))
+
+    # nobody watches a batch's handles page by page, so their lookups don't
+    # publish partial results
+    batch_lookup(handles, functools.partial(global_store, publish_partial=False),
+                 max_concurrent=int(os.environ.get('BATCH_CONCURRENCY', 8)),
+                 on_result=publish)
+    jobs.update(job_id, state='done', finished=time.time())
+
+
+def run_lookup(input_value, job_id):
+    """
+    Run a lookup job (on a celery worker, see jobs.py), publishing results
+    to the dataset store and the handle's lookup status as they come in.
+    """
+    jobs.update(job_id, state='running')
+    lookups.start(input_value)
+    try:
+        stored = global_store(input_value)
+    except Exception as e:
+        print('**ERROR**')
+        print(e)
+        print(input_value)
+        lookups.update(input_value, state='error')
+        jobs.update(job_id, state='error', finished=time.time())
+        return
+    if stored is None:
+        lookups.update(input_value, state='empty')
+        jobs.update(job_id, state='empty', finished=time.time())
+    else:
+        chunks, views, points = stored
+        dataset_key = datasets.put(input_value, chunks, views=views, points=points)
+        lookups.update(input_value, state='done', dataset=dataset_key,
+                       tweets=views['size'])
+        jobs.update(job_id, state='done', dataset=dataset_key,
+                    tweets=views['size'], finished=time.time())
+
 
-    return {
-        'data': [toxicity_trace],
-        'layout': dict(
-            xaxis={'type': 'linear', 'title': 'tweets'},
-            yaxis={'title': 'toxicity (%)', 'range': [0, 100]},
-            #title=f"The last {len(x)} tweets at {handle}",
-            title='The last {} tweets at {}'.format(len(x), handle),
-            #margin={'l': 40, 'b': 40, 't': 10, 'r': 10},
-            legend={'x': 0.1, 'y': 1.1},
-            hovermode='closest',
-            type='layout'
-        )
-    }
-
-
-@cache.memoize(timeout=60*30)  # 30 minutes
-def global_store(input_value):
-    tweet_start = time.time()
-    tweets_df = twitter_client.tweets_at(input_value)
-    tweet_end = time.time()
-    tweet_time = tweet_end - tweet_start
+def global_store(input_value, publish_partial=True):
+    """
+    Scored tweets at a handle, from the handle store if the lookup cache
+    says they can be served.  Cached results past the soft TTL are still
+    returned straight away, and one background refresh is queued for them.
+    A lookup that has to run publishes partial results unless
+    publish_partial is False.
+
+    Returns:
+        tuple: (scored tweets in the compact format, views dict from
+        make_views, point details from compact.encode_points), None if there
+        are no tweets at the handle
+    """
+    lookup_cache.touch(input_value)
+    cached = lookup_cache.get(input_value)
+    if cached is None:
+        lookup_cache_requests.inc(result='miss')
+        return refresh_handle(input_value, publish_partial)
+    found, age = cached
+    result = handle_store.result(input_value) if found else None
+    if found and result is None:
+        # the stored tweets went before the cache entry did
+        lookup_cache_requests.inc(result='miss')
+        return refresh_handle(input_value, publish_partial)
+    if lookup_cache.is_stale(age):
+        lookup_cache_requests.inc(result='stale')
+        if lookup_cache.claim_refresh(input_value):
+            jobs.submit_refresh(input_value)
+    else:
+        lookup_cache_requests.inc(result='fresh')
+    return result
+
+
+def refresh_handle(input_value, publish_partial=True):
+    """
+    Look up a handle and cache the result.  Concurrent lookups of the same
+    handle, from any process, share a single run of fetch_and_score.
+    """
+    result = flights.run(input_value.lower(), fetch_and_score, input_value,
+                         publish_partial)
+    lookup_cache.put(input_value, result is not None)
+    return result
+
+
+def run_refresh(input_value):
+    """
+    Background refresh of a handle (on a celery worker, see jobs.py)
+    """
+    with priority('background'):
+        refresh_handle(input_value)
+
+
+def warm_popular():
+    """
+    Queue refreshes for the most requested handles whose cached lookups
+    will go stale before the next warm-up, so their users never wait on a
+    cold lookup.  Stops early when the background lane of the twitter
+    search budget is used up.
+    """
+    lookup_cache.decay(factor=0.9)
+    horizon = lookup_cache.soft_ttl - int(os.environ.get('WARM_INTERVAL', 60*10))
+    for handle in lookup_cache.popular(warm_top_n):
+        if quotas['twitter:search'].available('background') <= 0:
+            print("background search budget used up, warming the rest next time")
+            break
+        cached = lookup_cache.get(handle)
+        if cached is not None and cached[1] < horizon:
+            continue
+        if lookup_cache.claim_refresh(handle):
+            jobs.submit_refresh(handle)
+
+
+def fetch_and_score(input_value, publish_partial=True):
+    """
+    Fetch and score up to max_tweets tweets at a handle, publishing partial
+    results as pages come in unless publish_partial is False.  If the handle
+    has been looked up before, only tweets newer than the stored ones are
+    fetched and scored and then merged into the stored tweets.
+
+    Returns:
+        tuple: (scored tweets as compact.encode_chunks chunks, views dict
+        from make_views, compact.encode_points of them), None if there are
+        no tweets at the handle
+    """
+    since_id, stored_df = handle_store.get(input_value)
+    # partial results are only shown for a first lookup: a refresh merges
+    # a few new pages into tweets that are already being shown.  They go into
+    # one dataset that grows by the chunks that changed since the last publish.
+    partial = (datasets.start(input_value)
+               if stored_df is None and publish_partial else None)
+    appended_rows = 0
+
+    def publish(scored_df):
+        nonlocal appended_rows
+        tweets = len(scored_df)
+        progress = {'pages': -(-tweets // Twitter.tweets_per_qry), 'tweets': tweets}
+        if partial is not None:
+            first = appended_rows // compact.chunk_rows
+            new_df = scored_df.iloc[appended_rows:]
+            progress['dataset'] = datasets.append(
+                partial, compact.encode_chunks(new_df), first,
+                make_views(scored_df), compact.encode_points(new_df))
+            appended_rows = tweets // compact.chunk_rows * compact.chunk_rows
+        lookups.update(input_value, **progress)
+
+    tweets_df = score_pages(twitter_client.get(), perspective_client.get(),
+                            input_value, since_id=since_id,
+                            on_page=publish if publish_partial else None,
+                            max_tweets=max_tweets)
+    if partial is not None:
+        datasets.finish(partial)
+
+    if stored_df is not None:
+        print(f"{len(tweets_df)} new tweets since {since_id}")
+        tweets_df = merge_tweets(tweets_df, stored_df, max_tweets)
 
     if not tweets_df.empty:
-        score_start = time.time()
-        #tweets_df = perspective_client.scores(tweets_df)
-        tweets_df = perspective_client.async_scores(tweets_df)
-        score_end = time.time()
-        score_time = score_end - score_start
-
-        print(f"tweet request time: {tweet_time}")
-        print(f"score request time: {score_time}")
-        return tweets_df
+        chunks = compact.encode_chunks(tweets_df)
+        views = make_views(tweets_df)
+        points = compact.encode_points(tweets_df)
+        handle_store.put(input_value, chunks, views, points)
+        return chunks, views, points
 
 
 if __name__ == '__main__':
@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def parse_handles(text):
+    """
+    Split a list of handles separated by whitespace or commas, adding the @
+    where it's missing and dropping repeats.
+
+    Returns:
+        list: handles in format @handle, in the order given
+    """
+    handles = (h.strip() for h in text.replace(',', ' ').split())
+    handles = (h if h.startswith('@') else '@' + h for h in handles if h.strip('@'))
+    return list(OrderedDict.fromkeys(handles))
+
+
+def batch_lookup(handles, lookup, max_concurrent=8, on_result=None):
+    """
+    Look up many handles at once.  Up to max_concurrent lookups run side by
+    side and, because they share the process's Twitter and Perspective
+    clients, their search pages and scoring requests interleave on the same
+    rate limits (the Perspective token bucket hands out slots in request
+    order, so no handle can starve the others).  Handles with a cached
+    lookup come straight from the cache.
+
+    Args:
+        handles(:obj:'list' of str): handles in format @handle
+        lookup(callable): handle -> (data, views, points) or None, e.g. global_store
+        max_concurrent(int): lookups running at once
+        on_result(callable): called with (handle, result) as each finishes
+
+    Returns:
+        OrderedDict: handle -> lookup result, None if it had no tweets or failed
+    """
+    results = OrderedDict((handle, None) for handle in handles)
+    with ThreadPoolExecutor(max_workers=max_concurrent) as pool:
+        futures = {pool.submit(lookup, handle): handle for handle in handles}
+        for future in as_completed(futures):
+            handle = futures[future]
+            try:
+                results[handle] = future.result()
+            except Exception as e:
+                print('**ERROR**')
+                print(e)
+                print(handle)
+            if on_result is not None:
+                on_result(handle, results[handle])
+    return results
+
+
+def comparison_row(result):
+    """
+    Per-level tweet counts for one handle's lookup result
+
+    Returns:
+        dict: level name -> count plus the total, None if there was no result
+    """
+    if result is None:
+        return None
+    views = result[1]
+    row = OrderedDict(views['counts'])
+    row['Total'] = views['size']
+    return row
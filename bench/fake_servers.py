@@ -0,0 +1,243 @@
+"""
+Local stand-ins for the Twitter search and Perspective APIs, so the pipeline
+can be benchmarked without keys and with controllable latency and errors.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from bisect import bisect_right
+from collections import deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+
+class Behaviour(object):
+    """
+    How a fake server responds: `latency` seconds per request (plus up to
+    `jitter` more), `error_rate` fraction of 503s and, if `quota_qps` is set,
+    429s for requests beyond that many per second.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, quota_qps=None,
+                 seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota_qps = quota_qps
+        self.random = random.Random(seed)
+        self.recent = deque()
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, '429': 0, '503': 0}
+
+    def respond(self):
+        """
+        Sleep for the request's latency and pick its status code
+        """
+        with self.lock:
+            self.counts['requests'] += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            status = 200
+            if self.quota_qps:
+                now = time.monotonic()
+                while self.recent and now - self.recent[0] > 1:
+                    self.recent.popleft()
+                if len(self.recent) >= self.quota_qps:
+                    status = 429
+                else:
+                    self.recent.append(now)
+            if status == 200 and self.random.random() < self.error_rate:
+                status = 503
+            if status != 200:
+                self.counts[str(status)] += 1
+        if delay:
+            time.sleep(delay)
+        return status
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, behaviour, **state):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.behaviour = behaviour
+        self.__dict__.update(state)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class PerspectiveHandler(JSONHandler):
+    """
+    POST /comments:analyze with deterministic scores derived from the text
+    """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        status = self.server.behaviour.respond()
+        if status != 200:
+            self.send_json(status, {'error': {'code': status, 'message': 'fake error'}})
+            return
+        text = body['comment']['text']
+        self.send_json(200, {
+            'attributeScores': {
+                model: {'summaryScore': {'value': fake_score(text, model),
+                                         'type': 'PROBABILITY'},
+                        'spanScores': [{'begin': 0, 'end': len(text),
+                                        'score': {'value': fake_score(text, model),
+                                                  'type': 'PROBABILITY'}}]}
+                for model in body['requestedAttributes']},
+            'languages': ['en']})
+
+
+class TwitterHandler(JSONHandler):
+    """
+    GET /search.json?count=&max_id=&since_id= over the server's corpus,
+    newest first like the search API
+    """
+
+    def do_GET(self):
+        status = self.server.behaviour.respond()
+        if status != 200:
+            self.send_json(status, {'errors': [{'code': 88, 'message': 'fake error'}]})
+            return
+        args = {k: int(v[0]) for k, v in parse_qs(urlparse(self.path).query).items()
+                if k in ('count', 'max_id', 'since_id')}
+        ids = self.server.ascending_ids
+        hi = bisect_right(ids, args['max_id']) if 'max_id' in args else len(ids)
+        lo = bisect_right(ids, args['since_id']) if 'since_id' in args else 0
+        lo = max(lo, hi - args.get('count', 15))
+        page = self.server.corpus[len(ids) - hi:len(ids) - lo]
+        self.send_json(200, {'statuses': page})
+
+
+def fake_score(text, model):
+    digest = hashlib.md5(f"{model}:{text}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big') / 2**32
+
+
+def perspective_server(behaviour=None):
+    return FakeServer(PerspectiveHandler, behaviour or Behaviour())
+
+
+def twitter_server(corpus, behaviour=None):
+    """
+    Args:
+        corpus(list): tweet json dicts, newest first
+    """
+    return FakeServer(TwitterHandler, behaviour or Behaviour(),
+                      corpus=corpus,
+                      ascending_ids=[t['id'] for t in reversed(corpus)])
+
+
+class SearchAPI(object):
+    """
+    Stand-in for tweepy.API's search method that talks to a fake twitter
+    server, for passing to Twitter(..., api=SearchAPI(url)).
+    """
+
+    def __init__(self, url):
+        self.url = url + '/search.json'
+        self.local = threading.local()
+
+    def search(self, q, count=15, tweet_mode=None, **kwargs):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        params = dict(q=q, count=count, **kwargs)
+        response = session.get(self.url, params=params)
+        response.raise_for_status()
+        return [SimpleNamespace(_json=t, id=t['id'])
+                for t in response.json()['statuses']]
+
+
+words = ('you are the worst idea ever and everyone knows it lol thanks for '
+         'sharing this great thread what a terrible take honestly stop '
+         'talking nobody asked love this so much').split()
+
+
+def synthetic_corpus(size, handle='@target', dup_rate=0.1, seed=0):
+    """
+    Tweets at handle shaped like search API results in extended mode, with
+    mentions, hashtags, urls and their entities.  `dup_rate` of them copy an
+    earlier tweet's text with a different mention, like a pile-on.
+
+    Returns:
+        list: tweet json dicts, newest first
+    """
+    rng = random.Random(seed)
+    newest = datetime(2018, 4, 1)
+    first_id = 980000000000000000
+    corpus = []
+    for i in range(size):
+        tweet_id = first_id - i * 1000 - rng.randint(0, 999)
+        screen_name = f"user{rng.randint(0, max(1, size // 4))}"
+        if corpus and rng.random() < dup_rate:
+            body = rng.choice(corpus)['_body']
+        else:
+            body = ' '.join(rng.choice(words) for _ in range(rng.randint(4, 30)))
+        mention = f"@friend{rng.randint(0, 50)}"
+        text = f"{handle} {mention} {body} #tag{rng.randint(0, 20)} https://t.co/x{i}"
+        corpus.append({
+            'id': tweet_id,
+            'id_str': str(tweet_id),
+            'created_at': (newest - timedelta(seconds=i * 7)).strftime(
+                '%a %b %d %H:%M:%S +0000 %Y'),
+            'full_text': text,
+            'display_text_range': [0, len(text)],
+            'entities': entities(text),
+            'user': {'id': rng.randint(0, 10**9), 'screen_name': screen_name,
+                     'followers_count': rng.randint(0, 10**5)},
+            'metadata': {'iso_language_code': 'en', 'result_type': 'recent'},
+            'lang': 'en',
+            '_body': body,
+        })
+    for tweet in corpus:
+        del tweet['_body']
+    return corpus
+
+
+def entities(text):
+    found = {'user_mentions': [], 'hashtags': [], 'urls': []}
+    position = 0
+    for token in text.split(' '):
+        indices = [position, position + len(token)]
+        if token.startswith('@'):
+            found['user_mentions'].append({'screen_name': token[1:], 'indices': indices})
+        elif token.startswith('#'):
+            found['hashtags'].append({'text': token[1:], 'indices': indices})
+        elif token.startswith('https://'):
+            found['urls'].append({'url': token, 'indices': indices})
+        position += len(token) + 1
+    return found
@@ -0,0 +1,83 @@
+"""
+Benchmark tweet normalization (scrub_tweets, which cuts out entities by their
+offsets and hashes the result) against the old regex tokenization followed by
+the separate truncate-and-hash the score cache used to do.  Before timing,
+scrub_tweet is checked against hand-scrubbed tweets.
+
+    python bench/normalize.py [rows ...]
+"""
+import hashlib
+import os
+import re
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_servers import synthetic_corpus  # noqa: E402
+from twitter import scrub_tweet, scrub_tweets  # noqa: E402
+
+models = ['TOXICITY', 'SEVERE_TOXICITY']
+legacy_pattern = re.compile(r'(?<![#@])\b\w+\b')
+
+
+def legacy(tweets_df):
+    """
+    Normalization as it was done before: a regex word scan per row through
+    Series.apply, then truncation and a hash per text when looking up the
+    score cache.
+    """
+    tweets_df['scrubbed_text'] = tweets_df['full_text'].apply(
+        lambda tweet: ' '.join(legacy_pattern.findall(tweet)))
+    model_part = ','.join(sorted(models))
+    return [hashlib.sha1(f'{model_part}\x00{t[:3000]}'.encode('utf-8')).hexdigest()
+            for t in tweets_df['scrubbed_text']]
+
+
+# (full_text as twitter sends it, entities, expected scrubbed text); entity
+# offsets are into the unescaped text
+examples = [
+    ('@alice you are &amp; always were #wrong https://t.co/x',
+     {'user_mentions': [{'indices': [0, 6]}],
+      'hashtags': [{'indices': [29, 35]}],
+      'urls': [{'indices': [36, 50]}]},
+     'you are & always were'),
+    ('a &lt;b&gt; c @bob d &amp; e',
+     {'user_mentions': [{'indices': [8, 12]}]},
+     'a <b> c d & e'),
+]
+
+
+def check():
+    for text, entities, expected in examples:
+        scrubbed = scrub_tweet(text, entities)
+        assert scrubbed == expected, (text, scrubbed, expected)
+
+
+def single_pass(tweets_df):
+    return scrub_tweets(tweets_df)['text_hash'].tolist()
+
+
+def best_of(fn, corpus, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        tweets_df = pd.DataFrame(corpus)
+        start = time.perf_counter()
+        fn(tweets_df)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(sizes):
+    check()
+    print(f"{'rows':>8} {'legacy (s)':>12} {'single pass (s)':>16} {'speedup':>8}")
+    for rows in sizes:
+        corpus = synthetic_corpus(rows)
+        old = best_of(legacy, corpus)
+        new = best_of(single_pass, corpus)
+        print(f"{rows:>8} {old:>12.4f} {new:>16.4f} {old / new:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [400, 10000, 100000])
@@ -0,0 +1,188 @@
+"""
+End-to-end benchmark of the lookup pipeline against local stand-in Twitter
+and Perspective servers (see fake_servers.py), so no API keys are needed.
+
+For each corpus size every stage is timed on its own and reports wall time,
+throughput and peak traced memory:
+
+    fetch       Twitter.tweets_at (search paging + scrub_tweets)
+    scrub       scrub_tweets on the raw frame
+    dedup       near_duplicates clustering of scrubbed texts
+    score       Perspective.cached_scores (no score cache)
+    categorize  add_scores + categorize_scores
+    views       make_views
+    encode      compact.encode
+    figures     bar_figure + toxicity_figure + level_area_figure, serialized
+                as dash would (also reports json and gzipped bytes)
+
+Usage:
+
+    python bench/pipeline.py --sizes 400 10000 100000 --latency 0.05 \\
+        --error-rate 0.01 --quota-qps 500 --save bench/baseline.json
+    python bench/pipeline.py --compare bench/baseline.json
+
+Peak memory comes from tracemalloc, which slows allocation-heavy stages
+down; pass --no-memory for timings closer to production.
+"""
+import argparse
+import gzip
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import pandas as pd
+import plotly
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import compact  # noqa: E402
+from fake_servers import (Behaviour, SearchAPI, perspective_server,  # noqa: E402
+                          synthetic_corpus, twitter_server)
+from dedup import near_duplicates  # noqa: E402
+from figures import bar_figure, level_area_figure, toxicity_figure  # noqa: E402
+from perspective import Perspective, add_scores, categorize_scores  # noqa: E402
+from twitter import Twitter, scrub_tweets  # noqa: E402
+from views import make_views  # noqa: E402
+
+handle = '@target'
+models = ['TOXICITY', 'SEVERE_TOXICITY']
+
+
+class Stages(object):
+    """
+    Times stages and keeps their results
+    """
+
+    def __init__(self, size, trace_memory=True):
+        self.size = size
+        self.trace_memory = trace_memory
+        self.results = OrderedDict()
+
+    def run(self, name, fn, *args, **extra):
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        value = fn(*args)
+        seconds = time.perf_counter() - start
+        peak = 0
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.results[name] = dict(seconds=round(seconds, 6),
+                                  per_second=round(self.size / seconds, 1) if seconds else None,
+                                  peak_mb=round(peak / 2**20, 3),
+                                  **extra)
+        return value
+
+
+def run_size(size, args):
+    corpus = synthetic_corpus(size, handle=handle, dup_rate=args.dup_rate)
+    twitter_behaviour = Behaviour(latency=args.twitter_latency)
+    perspective_behaviour = Behaviour(latency=args.latency, jitter=args.jitter,
+                                      error_rate=args.error_rate,
+                                      quota_qps=args.quota_qps)
+    stages = Stages(size, trace_memory=not args.no_memory)
+
+    with twitter_server(corpus, twitter_behaviour) as twitter_fake, \
+            perspective_server(perspective_behaviour) as perspective_fake:
+        twitter_client = Twitter(None, None, api=SearchAPI(twitter_fake.url),
+                                 slices=args.slices)
+        perspective_client = Perspective('bench', qps=args.qps,
+                                         max_in_flight=args.max_in_flight,
+                                         base_url=perspective_fake.url)
+
+        stages.run('fetch', twitter_client.tweets_at, handle, size)
+        raw_df = pd.DataFrame(corpus)
+        tweets_df = stages.run('scrub', scrub_tweets, raw_df)
+        clusters = stages.run('dedup', near_duplicates,
+                              tweets_df['scrubbed_text'].values, args.dedup_threshold)
+        stages.results['dedup']['clusters'] = len(set(clusters))
+        scores = stages.run('score', perspective_client.cached_scores,
+                            tweets_df['scrubbed_text'].tolist(), models,
+                            tweets_df['text_hash'].tolist())
+        stages.results['score'].update(
+            requests=perspective_behaviour.counts['requests'],
+            throttled=perspective_behaviour.counts['429'],
+            errors=perspective_behaviour.counts['503'])
+
+    tweets_df = stages.run('categorize',
+                           lambda: categorize_scores(add_scores(tweets_df, scores, models)))
+    views = stages.run('views', make_views, tweets_df)
+    data = stages.run('encode', compact.encode, tweets_df)
+    stages.results['encode']['bytes'] = len(data)
+    figures = stages.run('figures', lambda: json.dumps(
+        [bar_figure(views, handle), toxicity_figure(views, handle),
+         level_area_figure(views, handle)],
+        cls=plotly.utils.PlotlyJSONEncoder))
+    stages.results['figures']['bytes'] = len(figures)
+    stages.results['figures']['gzip_bytes'] = len(gzip.compress(figures.encode()))
+    return stages.results
+
+
+def report(results, baseline=None):
+    header = f"{'size':>8} {'stage':<11} {'seconds':>9} {'per sec':>11} {'peak MB':>8}"
+    if baseline:
+        header += f" {'vs base':>8}"
+    print(header)
+    for size, stages in results.items():
+        for stage, r in stages.items():
+            line = (f"{size:>8} {stage:<11} {r['seconds']:>9.4f} "
+                    f"{r['per_second'] or 0:>11.1f} {r['peak_mb']:>8.2f}")
+            base = (baseline or {}).get(size, {}).get(stage)
+            if base:
+                line += f" {r['seconds'] / base['seconds']:>7.2f}x"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[400, 10000, 100000])
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='perspective seconds per request')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='perspective extra random seconds per request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of perspective requests that 503')
+    parser.add_argument('--quota-qps', type=int, default=None,
+                        help='perspective requests per second before 429s')
+    parser.add_argument('--twitter-latency', type=float, default=0.0,
+                        help='twitter seconds per search page')
+    parser.add_argument('--slices', type=int, default=1,
+                        help='id slices to search in parallel, 1 for serial paging')
+    parser.add_argument('--qps', type=int, default=1000,
+                        help="client's perspective QPS budget")
+    parser.add_argument('--max-in-flight', type=int, default=20)
+    parser.add_argument('--dup-rate', type=float, default=0.1,
+                        help='fraction of tweets copying an earlier text')
+    parser.add_argument('--dedup-threshold', type=float, default=0.8)
+    parser.add_argument('--no-memory', action='store_true',
+                        help="don't trace peak memory")
+    parser.add_argument('--save', help='write results as json to this file')
+    parser.add_argument('--compare', help='baseline json to compare against')
+    args = parser.parse_args()
+
+    results = OrderedDict()
+    for size in args.sizes:
+        results[str(size)] = run_size(size, args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'meta': {'options': vars(args),
+                                'python': platform.python_version(),
+                                'pandas': pd.__version__,
+                                'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
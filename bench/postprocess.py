@@ -0,0 +1,95 @@
+"""
+Benchmark score post-processing (unpacking scores, categorizing, formatting
+times and screen names) against the old per-row apply implementation.
+
+    python bench/postprocess.py [rows ...]
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from perspective import add_scores, categorize_scores  # noqa: E402
+
+models = ['TOXICITY', 'SEVERE_TOXICITY']
+
+
+def synthetic(rows, error_rate=0.01, seed=0):
+    """
+    Tweets and perspective responses shaped like the real thing
+    """
+    rng = random.Random(seed)
+    start = datetime(2018, 4, 1)
+    created_at, users, scores = [], [], []
+    for i in range(rows):
+        t = start + timedelta(seconds=rng.randint(0, 60*60*24*7))
+        created_at.append(t.strftime('%a %b %d %H:%M:%S +0000 %Y'))
+        users.append({'screen_name': f"user{rng.randint(0, rows // 4)}",
+                      'id': i, 'followers_count': rng.randint(0, 10000)})
+        if rng.random() < error_rate:
+            scores.append({'error': {'status': 400, 'message': 'language'}})
+        else:
+            scores.append({'attributeScores': {
+                model: {'summaryScore': {'value': rng.random(), 'type': 'PROBABILITY'},
+                        'spanScores': [{'begin': 0, 'end': 10,
+                                        'score': {'value': rng.random()}}]}
+                for model in models}})
+    tweets_df = pd.DataFrame({'created_at': created_at, 'user': users})
+    return tweets_df, scores
+
+
+def legacy(tweets_df, scores):
+    """
+    Post-processing as it was done before: a dict column unpacked by
+    Series.apply once per model, strptime per row and a lambda per user.
+    """
+    def unpack_score(score, model_name):
+        if 'attributeScores' in score:
+            return round(score['attributeScores'][model_name]['summaryScore']['value'] * 100)
+        return 0
+
+    def format_time(time_stamp):
+        d = datetime.strptime(time_stamp, '%a %b %d %H:%M:%S +0000 %Y')
+        return d.strftime("%a %B %d %I:%M%p")
+
+    tweets_df['score'] = scores
+    for model in models:
+        tweets_df[model + '_score'] = tweets_df['score'].apply(unpack_score,
+                                                              model_name=model)
+    tweets_df['LOW_LEVEL'] = tweets_df['TOXICITY_score'] < 90
+    tweets_df['MED_LEVEL'] = ((tweets_df['TOXICITY_score'] > 90) &
+                              (tweets_df['SEVERE_TOXICITY_score'] < 65))
+    tweets_df['HI_LEVEL'] = tweets_df['SEVERE_TOXICITY_score'] > 65
+    tweets_df['display_time'] = tweets_df['created_at'].apply(format_time)
+    tweets_df['screen_name'] = tweets_df['user'].apply(lambda t: t['screen_name'])
+    return tweets_df
+
+
+def columnar(tweets_df, scores):
+    return categorize_scores(add_scores(tweets_df, scores, models))
+
+
+def best_of(fn, rows, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        tweets_df, scores = synthetic(rows)
+        start = time.perf_counter()
+        fn(tweets_df, scores)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(sizes):
+    print(f"{'rows':>8} {'legacy (s)':>12} {'columnar (s)':>13} {'speedup':>8}")
+    for rows in sizes:
+        old = best_of(legacy, rows)
+        new = best_of(columnar, rows)
+        print(f"{rows:>8} {old:>12.4f} {new:>13.4f} {old / new:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [400, 10000, 100000])
@@ -0,0 +1,119 @@
+"""
+Startup benchmark for the web app, the way `gunicorn app:server --preload`
+starts it:
+
+    import      seconds to import app.py in a fresh interpreter (median of
+                --runs), and the slowest imports by cumulative time from
+                python -X importtime
+    fork        seconds from forking an already imported parent to the
+                child's first response, i.e. how long a new worker takes to
+                come up after a restart or scale-up
+
+Importing app.py doesn't connect to redis or either API, so no servers are
+needed.
+
+Usage:
+
+    python bench/startup.py --runs 5 --top 15 --save bench/startup.json
+    python bench/startup.py --compare bench/startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+import_snippet = """
+import time
+start = time.perf_counter()
+import app
+print(time.perf_counter() - start)
+"""
+
+fork_snippet = """
+import os
+import time
+import app
+
+client_paths = ['/', '/_dash-layout', '/_dash-dependencies']
+read, write = os.pipe()
+start = time.perf_counter()
+pid = os.fork()
+if pid == 0:
+    client = app.server.test_client()
+    for path in client_paths:
+        client.get(path)
+    os.write(write, str(time.perf_counter() - start).encode())
+    os._exit(0)
+os.waitpid(pid, 0)
+print(os.read(read, 64).decode())
+"""
+
+
+def run(snippet, *flags):
+    result = subprocess.run([sys.executable] + list(flags) + ['-c', snippet],
+                            cwd=root, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, check=True)
+    return result.stdout.decode(), result.stderr.decode()
+
+
+def slowest_imports(top):
+    """
+    Returns:
+        list: (module, cumulative seconds) of the top slowest imports
+    """
+    _, stderr = run('import app', '-X', 'importtime')
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        imports.append((module.strip(), int(cumulative) / 1e6))
+    return sorted(imports, key=lambda i: -i[1])[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15,
+                        help='slowest imports to list')
+    parser.add_argument('--save', help='write results as json to this file')
+    parser.add_argument('--compare', help='baseline json to compare against')
+    args = parser.parse_args()
+
+    results = OrderedDict()
+    results['import'] = statistics.median(
+        float(run(import_snippet)[0]) for _ in range(args.runs))
+    results['fork'] = statistics.median(
+        float(run(fork_snippet)[0]) for _ in range(args.runs))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    for stage, seconds in results.items():
+        line = f"{stage:<8} {seconds:>9.4f}s"
+        if baseline and stage in baseline:
+            line += f" {seconds / baseline[stage]:>7.2f}x"
+        print(line)
+    print()
+    for module, seconds in slowest_imports(args.top):
+        print(f"{seconds:>9.4f}s  {module}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'meta': {'options': vars(args),
+                                'python': platform.python_version(),
+                                'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
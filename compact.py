@@ -0,0 +1,222 @@
+"""
+Compact storage format for scored tweets.
+
+Only the columns the dashboard uses are kept, each as its own typed array in
+an npz archive so a reader can load just the columns it needs:
+
+    id            int64
+    created       int64 nanoseconds since the epoch (UTC)
+    score__MODEL  uint8 percentage, 255 where the tweet couldn't be scored
+    levels        uint8 bit flags, see level_bits
+    cluster       int64 id of the tweet whose score a near duplicate shares
+                  (optional, see dedup.py)
+    text__*       full_text, deduplicated: utf-8 blob + offsets + int32 codes
+    screen_name__* same for screen names
+
+id_str, display_time, scored and the LOW/MED/HI_LEVEL booleans are derived
+from these when decoding.  Nothing is pickled.
+
+Stores keep a handle's tweets as a list of archives of `chunk_rows` rows
+each (encode_chunks), so reading a few rows only decodes the chunks they
+are in.  Next to each chunk the toxicity graph's click-through details of
+its tweets are kept as an archive of their own (encode_points), so drawing
+the graph doesn't fetch the chunks and nothing else fetches the details.
+"""
+import io
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from perspective import format_times
+
+
+schema_version = 1
+chunk_rows = 1000
+unscored = 255
+level_bits = OrderedDict([('LOW_LEVEL', 1),
+                          ('MED_LEVEL', 2),
+                          ('HI_LEVEL', 4),
+                          ('scored', 8)])
+string_columns = OrderedDict([('full_text', 'text'),
+                              ('screen_name', 'screen_name')])
+# characters of each tweet's text kept in its point details
+snippet_length = 140
+# the point details decode_points returns, in the order the graph sends them
+point_fields = ('screen_name', 'id_str', 'snippet', 'snippet_cut')
+
+
+def encode(tweets_df):
+    """
+    Args:
+        tweets_df(DataFrame): scored and categorized tweets
+
+    Returns:
+        bytes: compressed npz archive
+    """
+    arrays = {'version': np.array([schema_version], dtype=np.int16),
+              'id': tweets_df['id'].values.astype(np.int64),
+              'created': tweets_df['created'].values.astype('datetime64[ns]').view(np.int64)}
+
+    for col in tweets_df.columns:
+        if col.endswith('_score'):
+            values = tweets_df[col].values.astype(np.float64)
+            arrays['score__' + col[:-len('_score')]] = np.where(
+                np.isnan(values), unscored, values).astype(np.uint8)
+
+    levels = np.zeros(len(tweets_df), dtype=np.uint8)
+    for col, bit in level_bits.items():
+        levels |= np.where(tweets_df[col].values.astype(bool), bit, 0).astype(np.uint8)
+    arrays['levels'] = levels
+    if 'cluster' in tweets_df:
+        arrays['cluster'] = tweets_df['cluster'].values.astype(np.int64)
+
+    for col, name in string_columns.items():
+        codes, offsets, blob = encode_strings(tweets_df[col].values)
+        arrays[name + '__codes'] = codes
+        arrays[name + '__offsets'] = offsets
+        arrays[name + '__blob'] = blob
+
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def encode_chunks(tweets_df, rows=chunk_rows):
+    """
+    Returns:
+        list: encoded archives of consecutive slices of rows rows
+    """
+    return [encode(tweets_df.iloc[start:start + rows])
+            for start in range(0, len(tweets_df), rows)]
+
+
+def decode_chunks(chunks, columns=None):
+    """
+    Returns:
+        DataFrame: the chunks from encode_chunks decoded and concatenated
+    """
+    return pd.concat([decode(chunk, columns) for chunk in chunks],
+                     ignore_index=True)
+
+
+def decode(data, columns=None):
+    """
+    Args:
+        data(bytes): output of encode
+        columns(:obj:'list' of str): columns to decode, all if None
+
+    Returns:
+        DataFrame: the requested columns in dashboard form
+    """
+    with np.load(io.BytesIO(data)) as archive:
+        if columns is None:
+            columns = available_columns(archive)
+        decoded = OrderedDict((col, decode_column(archive, col)) for col in columns)
+    return pd.DataFrame(decoded, columns=columns)
+
+
+def available_columns(archive):
+    score_columns = [f[len('score__'):] + '_score' for f in archive.files
+                     if f.startswith('score__')]
+    columns = (['id', 'id_str', 'created', 'display_time'] + list(string_columns) +
+               sorted(score_columns) + list(level_bits))
+    if 'cluster' in archive.files:
+        columns.append('cluster')
+    return columns
+
+
+def decode_column(archive, col):
+    if col in ('id', 'cluster'):
+        return archive[col]
+    if col == 'id_str':
+        return archive['id'].astype(str).astype(object)
+    if col == 'created':
+        return archive['created'].view('datetime64[ns]')
+    if col == 'display_time':
+        return format_times(archive['created'].view('datetime64[ns]'))
+    if col in string_columns:
+        return decode_strings(archive, string_columns[col])
+    if col in level_bits:
+        return (archive['levels'] & level_bits[col]) != 0
+    if col.endswith('_score'):
+        values = archive['score__' + col[:-len('_score')]].astype(np.float64)
+        values[values == unscored] = np.nan
+        return values
+    raise KeyError(col)
+
+
+def encode_points(tweets_df, rows=chunk_rows):
+    """
+    Returns:
+        list: per chunk of encode_chunks, an archive of its tweets' ids,
+        screen names, texts cut to snippet_length and whether they were cut
+    """
+    chunks = []
+    for start in range(0, len(tweets_df), rows):
+        chunk_df = tweets_df.iloc[start:start + rows]
+        full_text = chunk_df['full_text'].tolist()
+        arrays = {'id': chunk_df['id'].values.astype(np.int64),
+                  'snippet_cut': np.array([len(text) > snippet_length
+                                           for text in full_text], dtype=bool)}
+        for name, values in (('screen_name', chunk_df['screen_name'].values),
+                             ('snippet', np.array([text[:snippet_length] for text in full_text],
+                                                  dtype=object))):
+            codes, offsets, blob = encode_strings(values)
+            arrays[name + '__codes'] = codes
+            arrays[name + '__offsets'] = offsets
+            arrays[name + '__blob'] = blob
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        chunks.append(buffer.getvalue())
+    return chunks
+
+
+def decode_points(data, rows):
+    """
+    Args:
+        data(bytes): one archive from encode_points
+        rows(ndarray): positions within the chunk, only these are decoded
+
+    Returns:
+        OrderedDict: point_fields -> array of the rows
+    """
+    with np.load(io.BytesIO(data)) as archive:
+        return OrderedDict([
+            ('screen_name', decode_strings(archive, 'screen_name', rows)),
+            ('id_str', archive['id'][rows].astype(str).astype(object)),
+            ('snippet', decode_strings(archive, 'snippet', rows)),
+            ('snippet_cut', archive['snippet_cut'][rows]),
+        ])
+
+
+def encode_strings(values):
+    """
+    Deduplicate strings into a utf-8 blob of the distinct values, their
+    offsets into the blob and an int32 code per row.
+    """
+    codes, uniques = pd.factorize(values)
+    encoded = [u.encode('utf-8') for u in uniques]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return codes.astype(np.int32), offsets, blob
+
+
+def decode_strings(archive, name, rows=None):
+    """
+    Decode the strings encode_strings stored as name, of every row or only
+    of the rows given
+    """
+    blob = archive[name + '__blob'].tobytes()
+    offsets = archive[name + '__offsets']
+    codes = archive[name + '__codes']
+    if rows is not None:
+        codes = codes[rows]
+        wanted = np.unique(codes)
+    else:
+        wanted = range(len(offsets) - 1)
+    uniques = np.empty(len(offsets) - 1, dtype=object)
+    for i in wanted:
+        uniques[i] = blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+    return uniques[codes]
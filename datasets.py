@@ -0,0 +1,364 @@
+import hashlib
+import math
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from redis.exceptions import RedisError
+
+import compact
+from metrics import registry, size_buckets
+
+
+dataset_bytes = registry.histogram('dataset_bytes',
+                                   'Size of a stored dataset in the compact format',
+                                   buckets=size_buckets)
+
+
+class DatasetStore(object):
+    """
+    Keeps scored tweet frames on the server so dash callbacks only pass a
+    small dataset key around instead of the whole frame as json.
+
+    Datasets are stored in the compact format, in chunks of consecutive
+    rows (compact.encode_chunks) that each keep every column as its own
+    array, so a callback only fetches the chunks holding the rows it shows
+    and only decodes the columns it draws.  The precomputed views from
+    views.make_views are stored alongside, and so are the toxicity graph's
+    point details per chunk (compact.encode_points), which only get_points
+    reads.  Each worker also keeps its most recently used datasets, and the
+    chunks, columns and point details loaded from them so far, in memory.
+
+    A lookup's partial results go into one dataset that only grows at the
+    end (start and append).  Each append stores the chunks that changed and
+    returns a new key naming that version, `<key>@<rows>`, whose rows never
+    change afterwards.
+    """
+    prefix = 'dataset:'
+
+    def __init__(self, redis_client, ttl=60*60*2, memory_size=16):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, handle, chunks, views=None, points=None):
+        """
+        Store a dataset and return the key callbacks use to read it back.
+        Identical results for a handle share a key.
+
+        Args:
+            handle(str): handle of twitter user in format @handle
+            chunks(:obj:'list' of bytes): scored tweets from compact.encode_chunks
+            views(dict): views from views.make_views
+            points(:obj:'list' of bytes): compact.encode_points of the same
+                tweets
+
+        Returns:
+            str: dataset key
+        """
+        digest = hashlib.sha1()
+        for chunk in chunks:
+            digest.update(chunk)
+        key = f"{handle.lower()}:{digest.hexdigest()[:16]}"
+        dataset_bytes.observe(sum(len(chunk) for chunk in chunks))
+
+        self._remember(key, {'chunks': dict(enumerate(chunks)), 'count': len(chunks),
+                             'views': views, 'rows': None, 'columns': {},
+                             'points': dict(enumerate(points or []))})
+        fields = {f'chunk:{i}': chunk for i, chunk in enumerate(chunks)}
+        fields.update((f'points:{i}', chunk) for i, chunk in enumerate(points or []))
+        fields.update(chunks=len(chunks), views=pickle.dumps(views))
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hmset(self.prefix + key, fields)
+            pipe.expire(self.prefix + key, self.ttl)
+            pipe.execute()
+        except RedisError as e:
+            print(e)
+        return key
+
+    def start(self, handle):
+        """
+        Returns:
+            str: key of a new dataset for a lookup of handle to append its
+            partial results to
+        """
+        return f"{handle.lower()}:partial:{uuid.uuid4().hex[:16]}"
+
+    def append(self, key, chunks, first, views, points=None):
+        """
+        Publish the next version of a dataset from start.  Rows are only ever
+        added at the end, so the chunks before `first` are full and already
+        stored; only the chunks from `first` on are written.  The previous
+        version's views are dropped, so readers of it move on.
+
+        Args:
+            key(str): dataset key from start
+            chunks(:obj:'list' of bytes): compact.encode_chunks of the rows
+                from chunk `first` on
+            first(int): index of the first chunk in chunks
+            views(dict): views of every row, from views.make_views
+            points(:obj:'list' of bytes): compact.encode_points of the same
+                rows as chunks
+
+        Returns:
+            str: key of this version
+        """
+        version = f"{key}@{views['size']}"
+        fields = {f'chunk:{first + i}': chunk for i, chunk in enumerate(chunks)}
+        fields.update((f'points:{first + i}', chunk) for i, chunk in enumerate(points or []))
+        fields.update({f"views@{views['size']}": pickle.dumps(views),
+                       'latest': views['size']})
+        try:
+            previous = self.redis.hget(self.prefix + key, 'latest')
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hmset(self.prefix + key, fields)
+            if previous is not None and int(previous) != views['size']:
+                pipe.hdel(self.prefix + key, f"views@{int(previous)}")
+            pipe.expire(self.prefix + key, self.ttl)
+            pipe.execute()
+        except RedisError as e:
+            print(e)
+        return version
+
+    def finish(self, key, ttl=60):
+        """
+        Expire a dataset from start soon, once the lookup's final result is
+        stored, leaving pollers a moment to move on to it
+        """
+        try:
+            self.redis.expire(self.prefix + key, ttl)
+        except RedisError as e:
+            print(e)
+
+    def add_sent(self, key, json_bytes, sent_bytes):
+        """
+        Add a callback response drawn from a dataset to its payload totals.
+        The versions of a dataset from start share one total, kept apart
+        from the dataset so that adding to it never brings back one that
+        has expired.
+        """
+        sent_key = self.prefix + 'sent:' + split_version(key)[0]
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hincrby(sent_key, 'json_bytes', json_bytes)
+            pipe.hincrby(sent_key, 'sent_bytes', sent_bytes)
+            pipe.expire(sent_key, self.ttl)
+            pipe.execute()
+        except RedisError as e:
+            print(e)
+
+    def sent(self, key):
+        """
+        Returns:
+            dict: json_bytes and sent_bytes of every callback response drawn
+            from the dataset so far
+        """
+        try:
+            totals = self.redis.hmget(self.prefix + 'sent:' + split_version(key)[0],
+                                      ['json_bytes', 'sent_bytes'])
+        except RedisError as e:
+            print(e)
+            return {}
+        return {'json_bytes': int(totals[0] or 0), 'sent_bytes': int(totals[1] or 0)}
+
+    def get(self, key, columns=None, rows=None):
+        """
+        Args:
+            key(str): dataset key from put
+            columns(:obj:'list' of str): columns to load, all if None
+            rows(:obj:'list' of int): positions of the rows to load, in the
+                order wanted, every row if None
+
+        Returns:
+            DataFrame: the requested columns, None if the dataset has expired
+        """
+        if columns is not None:
+            selected = self.get_columns(key, columns, rows)
+            return None if selected is None else pd.DataFrame(selected, columns=columns)
+        entry = self._entry(key)
+        if entry is None:
+            return None
+        rows, needed = self._needed(entry, rows)
+        if not self._load_chunks(key, entry, needed):
+            return None
+        tweets_df = compact.decode_chunks([entry['chunks'][i] for i in needed])
+        if rows is None:
+            return tweets_df.iloc[:entry['rows']]
+        return tweets_df.iloc[positions(rows, needed)].reset_index(drop=True)
+
+    def get_columns(self, key, columns, rows=None):
+        """
+        Same as get but without building a frame, for callbacks that only
+        read a few rows
+
+        Returns:
+            OrderedDict: column name -> array of the requested rows, None if
+            the dataset has expired
+        """
+        entry = self._entry(key)
+        if entry is None:
+            return None
+        rows, needed = self._needed(entry, rows)
+        if not self._load_chunks(key, entry, needed):
+            return None
+        decoded = entry['columns']
+        for i in needed:
+            missing = [col for col in columns if (i, col) not in decoded]
+            if missing:
+                chunk_df = compact.decode(entry['chunks'][i], missing)
+                decoded.update(((i, col), chunk_df[col].values) for col in missing)
+        selected = OrderedDict()
+        for col in columns:
+            if len(needed) == 1:
+                values = decoded[(needed[0], col)]
+            else:
+                values = np.concatenate([decoded[(i, col)] for i in needed])
+            if rows is None:
+                # a partial version's last chunk may have been rewritten
+                # with rows added since
+                selected[col] = values[:entry['rows']]
+            else:
+                selected[col] = values[positions(rows, needed)]
+        return selected
+
+    @staticmethod
+    def _needed(entry, rows):
+        """
+        Returns:
+            tuple: (rows as an array or None, sorted chunks holding them)
+        """
+        if rows is None:
+            return None, list(range(entry['count']))
+        rows = np.asarray(rows, dtype=np.int64)
+        return rows, sorted(set((rows // compact.chunk_rows).tolist()))
+
+    def get_views(self, key):
+        """
+        Returns:
+            dict: the views stored with a dataset, None if expired or missing
+        """
+        entry = self._entry(key)
+        return entry['views'] if entry is not None else None
+
+    def get_points(self, key, rows):
+        """
+        The toxicity graph's point details of some rows.  Only the details
+        of the chunks holding them are fetched, and only their strings
+        are decoded.
+
+        Args:
+            key(str): dataset key from put or append
+            rows(:obj:'list' of int): positions of the rows, in the order
+                wanted
+
+        Returns:
+            OrderedDict: compact.point_fields -> array of the rows, None if
+            the dataset has expired or was stored without point details
+        """
+        entry = self._entry(key)
+        if entry is None:
+            return None
+        rows, needed = self._needed(entry, rows)
+        missing = [i for i in needed if i not in entry['points']]
+        if missing:
+            try:
+                points = self.redis.hmget(self.prefix + split_version(key)[0],
+                                          [f'points:{i}' for i in missing])
+            except RedisError as e:
+                print(e)
+                return None
+            if any(chunk is None for chunk in points):
+                return None
+            entry['points'].update(zip(missing, points))
+        chunk_of = rows // compact.chunk_rows
+        order = np.argsort(chunk_of, kind='mergesort')
+        parts = [compact.decode_points(entry['points'][i],
+                                       rows[chunk_of == i] % compact.chunk_rows)
+                 for i in needed]
+        selected = OrderedDict()
+        for field in compact.point_fields:
+            values = np.concatenate([part[field] for part in parts])
+            selected[field] = np.empty_like(values)
+            selected[field][order] = values
+        return selected
+
+    def _entry(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                return entry
+        name, version = split_version(key)
+        try:
+            if version:
+                views, = self.redis.hmget(self.prefix + name, [f'views@{version}'])
+                count = math.ceil(int(version) / compact.chunk_rows)
+            else:
+                count, views = self.redis.hmget(self.prefix + name, ['chunks', 'views'])
+        except RedisError as e:
+            print(e)
+            return None
+        if count is None or views is None:
+            return None
+        entry = {'chunks': {}, 'count': int(count), 'views': pickle.loads(views),
+                 'rows': int(version) if version else None, 'columns': {},
+                 'points': {}}
+        self._remember(key, entry)
+        return entry
+
+    def _load_chunks(self, key, entry, needed):
+        """
+        Fetch the chunks in needed that this worker doesn't have yet
+
+        Returns:
+            bool: False if the dataset expired in the meantime
+        """
+        missing = [i for i in needed if i not in entry['chunks']]
+        if not missing:
+            return True
+        try:
+            chunks = self.redis.hmget(self.prefix + split_version(key)[0],
+                                      [f'chunk:{i}' for i in missing])
+        except RedisError as e:
+            print(e)
+            return False
+        if any(chunk is None for chunk in chunks):
+            return False
+        entry['chunks'].update(zip(missing, chunks))
+        return True
+
+    def _remember(self, key, entry):
+        with self.lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+
+
+def split_version(key):
+    """
+    Split the version append gave a dataset key off it.  Keys start with
+    the handle's own '@', so only a last '@' followed by digits counts.
+
+    Returns:
+        tuple: (key of the dataset, version or None)
+    """
+    name, _, version = key.rpartition('@')
+    if name and version.isdigit():
+        return name, version
+    return key, None
+
+
+def positions(rows, chunks):
+    """
+    Positions of rows within the concatenation of the given sorted chunks
+    """
+    chunks = np.asarray(chunks, dtype=np.int64)
+    within = np.searchsorted(chunks, rows // compact.chunk_rows)
+    return within * compact.chunk_rows + rows % compact.chunk_rows
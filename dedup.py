@@ -0,0 +1,87 @@
+"""
+Near-duplicate clustering of scrubbed tweet texts with MinHash and LSH, so a
+pile-on of copy-pasted tweets that differ by a word or an emoji is scored
+once instead of once per tweet.
+"""
+import re
+import zlib
+
+import numpy as np
+
+
+prime = (1 << 31) - 1
+whitespace = re.compile(r'\s+')
+
+
+def near_duplicates(texts, threshold=0.8, num_perm=64, shingle_size=5, seed=1):
+    """
+    Cluster texts whose estimated Jaccard similarity (over character
+    shingles) is at least threshold.
+
+    Args:
+        texts(:obj:'list' of str): scrubbed texts
+        threshold(float): similarity in (0, 1] above which texts are clustered
+        num_perm(int): number of MinHash permutations
+
+    Returns:
+        ndarray: for every text, the index of its cluster's representative
+        (the cluster's first text)
+    """
+    signatures = minhash_signatures(texts, num_perm, shingle_size, seed)
+    bands, rows = lsh_shape(threshold, num_perm)
+    parents = np.arange(len(texts))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for band in range(bands):
+        buckets = {}
+        band_values = signatures[:, band * rows:(band + 1) * rows]
+        for i in range(len(texts)):
+            first = buckets.setdefault(band_values[i].tobytes(), i)
+            if first == i:
+                continue
+            similarity = np.mean(signatures[i] == signatures[first])
+            if similarity >= threshold:
+                a, b = find(i), find(first)
+                parents[max(a, b)] = min(a, b)
+
+    return np.array([find(i) for i in range(len(texts))], dtype=np.int64)
+
+
+def minhash_signatures(texts, num_perm=64, shingle_size=5, seed=1):
+    """
+    Returns:
+        ndarray: (len(texts), num_perm) int64 MinHash signatures
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, prime, size=num_perm).astype(np.int64)
+    b = rng.randint(0, prime, size=num_perm).astype(np.int64)
+    signatures = np.empty((len(texts), num_perm), dtype=np.int64)
+    for i, text in enumerate(texts):
+        hashes = shingle_hashes(text, shingle_size)
+        signatures[i] = ((np.outer(a, hashes) + b[:, None]) % prime).min(axis=1)
+    return signatures
+
+
+def shingle_hashes(text, shingle_size=5):
+    text = whitespace.sub(' ', text.lower()).strip()
+    if len(text) <= shingle_size:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + shingle_size] for i in range(len(text) - shingle_size + 1)}
+    return np.fromiter((zlib.crc32(s.encode('utf-8')) & prime for s in shingles),
+                       dtype=np.int64, count=len(shingles))
+
+
+def lsh_shape(threshold, num_perm):
+    """
+    Pick (bands, rows per band) so that the LSH candidate threshold,
+    (1 / bands) ** (1 / rows), is as close to threshold as possible.
+    """
+    shapes = [(bands, num_perm // bands) for bands in range(1, num_perm + 1)
+              if num_perm % bands == 0]
+    return min(shapes, key=lambda s: abs((1 / s[0]) ** (1 / s[1]) - threshold))
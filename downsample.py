@@ -0,0 +1,67 @@
+"""
+Server-side decimation of the per-tweet series, so figures stay a bounded
+size however many tweets a handle has.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+
+def lttb(y, threshold):
+    """
+    Pick the points of a series that keep its shape, with
+    Largest-Triangle-Three-Buckets: the first and last points, and from each
+    of threshold - 2 buckets in between the point making the largest
+    triangle with the point kept before it and the average of the next
+    bucket.  NaNs are skipped.
+
+    Args:
+        y(ndarray): series, x is its index
+        threshold(int): number of points to keep
+
+    Returns:
+        ndarray: indexes into y of the points kept, ascending
+    """
+    valid = np.flatnonzero(~np.isnan(y))
+    n = len(valid)
+    if threshold >= n or threshold < 3:
+        return valid
+    xs = valid.astype(np.float64)
+    ys = y[valid].astype(np.float64)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    edges = np.append(edges, n)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_start, next_end = edges[i + 1], edges[i + 2]
+        avg_x = xs[next_start:next_end].mean()
+        avg_y = ys[next_start:next_end].mean()
+        area = np.abs((xs[a] - avg_x) * (ys[start:end] - ys[a]) -
+                      (xs[a] - xs[start:end]) * (avg_y - ys[a]))
+        a = start + int(np.argmax(area))
+        keep[i + 1] = a
+    return valid[keep]
+
+
+def level_buckets(created, level_rows, start, end, buckets):
+    """
+    Count the tweets of each level in equal time buckets between start and
+    end.
+
+    Args:
+        created(ndarray): int64 seconds since the epoch per tweet
+        level_rows(dict): level name -> row indexes, as in views.make_views
+        start, end(float): seconds since the epoch
+        buckets(int): number of buckets
+
+    Returns:
+        tuple: (bucket edges, OrderedDict of level name -> counts per bucket)
+    """
+    if end <= start:
+        end = start + 1
+    edges = np.linspace(start, end, buckets + 1)
+    counts = OrderedDict((name, np.histogram(created[rows], bins=edges)[0])
+                         for name, rows in level_rows.items())
+    return edges, counts
@@ -0,0 +1,189 @@
+"""
+Plotly figures for the dashboard, built from the views computed in
+views.make_views so they can be rendered (and benchmarked) without a frame.
+Per-tweet series are decimated to at most a few points per pixel, so a
+figure's size doesn't grow with the number of tweets.
+"""
+import numpy as np
+
+from downsample import level_buckets, lttb
+from wire import customdata, numbers
+
+
+colors = {
+    'background': 'white',
+    'text': 'black',
+    'high': '#D400F9',
+    'medium': '#6d60fe',
+    'low': '#25C1F9',
+}
+
+
+def bar_figure(views, handle):
+    """
+    Aggregate bar graph of tweet counts per toxicity level
+    """
+    begin_date = views['begin_date']
+    end_date = views['end_date']
+    title = f"tweets at {handle}: {begin_date}  –  {end_date} (UTC)"
+
+    data = dict(
+        type='bar',
+        x=list(views['counts'].keys()),
+        y=list(views['counts'].values()),
+        marker=dict(
+            color=[colors['low'],
+                   colors['medium'],
+                   colors['high']])
+    )
+
+    return {
+        'data': [data],
+        'layout': dict(
+            type='layout',
+            title=title,
+            xaxis={'title': 'toxicity level'},
+            yaxis={'title': 'count'},
+        )
+    }
+
+
+def toxicity_figure(views, handle, x_range=None, max_points=1000, points=None):
+    """
+    Line/scatter graph of toxicity per tweet, downsampled with LTTB to at
+    most max_points.  x is the tweet's number (1 for the newest), so the
+    points kept can still be clicked through to their tweets.  Given
+    points, each point kept carries [screen name, status id, text cut to
+    compact.snippet_length, whether it was cut] as customdata, so a click
+    needs no dataset lookup.
+
+    Args:
+        x_range(tuple): (first, last) tweet numbers to draw, all if None
+        max_points(int): most points to send, about the graph's width in pixels
+        points(function): row positions -> their point details, as from
+            DatasetStore.get_points
+    """
+    size = views['size']
+    first, last = 1, size
+    if x_range is not None:
+        first = max(1, int(np.floor(x_range[0])))
+        last = min(size, int(np.ceil(x_range[1])))
+    visible = views['toxicity'][first - 1:last]
+    kept = lttb(visible, max_points)
+    x = (kept + first).tolist()
+
+    xaxis = {'type': 'linear', 'title': 'tweets'}
+    if x_range is not None:
+        xaxis['range'] = list(x_range)
+
+    toxicity_trace = dict(
+        x=x,
+        y=numbers(visible[kept]),
+        mode='lines',
+        fill='tonexty',
+        name='toxicity',
+        line=dict(width=0.5,
+                 color='rgb(111, 200, 219)'),
+        type='scatter'
+    )
+    details = points(kept + first - 1) if points is not None else None
+    if details is not None:
+        toxicity_trace['customdata'] = customdata(details)
+
+    return {
+        'data': [toxicity_trace],
+        'layout': dict(
+            xaxis=xaxis,
+            yaxis={'title': 'toxicity (%)', 'range': [0, 100]},
+            #title=f"The last {len(x)} tweets at {handle}",
+            title='The last {} tweets at {}'.format(size, handle),
+            #margin={'l': 40, 'b': 40, 't': 10, 'r': 10},
+            legend={'x': 0.1, 'y': 1.1},
+            hovermode='closest',
+            type='layout'
+        )
+    }
+
+
+def level_area_figure(views, handle, time_range=None, tweets_per_bucket=10,
+                      max_buckets=100):
+    """
+    Stacked area chart of how many tweets of each toxicity level were
+    posted per time bucket.  Buckets are sized to hold about
+    tweets_per_bucket tweets of the visible range on average, and there
+    are never more than max_buckets.
+
+    Args:
+        time_range(tuple): (start, end) seconds since the epoch to bucket,
+                           all tweets if None
+    """
+    created = views['created']
+    start, end = created.min(), created.max()
+    if time_range is not None:
+        start, end = time_range
+    visible = np.count_nonzero((created >= start) & (created <= end))
+    buckets = int(np.clip(visible // tweets_per_bucket, 1, max_buckets))
+    edges, counts = level_buckets(created, views['level_rows'], start, end, buckets)
+    middles = ((edges[:-1] + edges[1:]) / 2).astype('datetime64[s]')
+    x = np.datetime_as_string(middles).tolist()
+
+    level_colors = {'Low': colors['low'], 'Medium': colors['medium'],
+                    'High': colors['high']}
+    stacked = np.zeros(buckets, dtype=np.int64)
+    data = []
+    for level, level_counts in counts.items():
+        stacked = stacked + level_counts
+        data.append(dict(type='scatter',
+                         name=level.lower(),
+                         x=x,
+                         y=stacked.tolist(),
+                         text=level_counts.tolist(),
+                         hoverinfo='x+text+name',
+                         mode='lines',
+                         line=dict(width=0.5, color=level_colors[level]),
+                         fill='tonexty' if data else 'tozeroy'))
+
+    xaxis = {'type': 'date', 'title': 'time (UTC)'}
+    if time_range is not None:
+        xaxis['range'] = [str(np.datetime64(int(t), 's')) for t in time_range]
+    return {
+        'data': data,
+        'layout': dict(
+            type='layout',
+            title=f"Toxicity levels over time at {handle}",
+            showlegend=True,
+            xaxis=xaxis,
+            yaxis={'type': 'linear', 'title': 'tweets per bucket'},
+        )
+    }
+
+
+def comparison_figure(comparison):
+    """
+    Stacked bar graph of tweet counts per toxicity level for several handles
+
+    Args:
+        comparison(dict): handle -> level counts from batch.comparison_row,
+                          None for handles without tweets
+    """
+    handles = [h for h, row in comparison.items() if row is not None]
+    level_colors = [('Low', colors['low']),
+                    ('Medium', colors['medium']),
+                    ('High', colors['high'])]
+    data = [dict(type='bar',
+                 name=level,
+                 x=handles,
+                 y=[comparison[h][level] for h in handles],
+                 marker=dict(color=color))
+            for level, color in level_colors]
+
+    return {
+        'data': data,
+        'layout': dict(
+            type='layout',
+            barmode='stack',
+            title=f"toxicity levels for {len(handles)} of {len(comparison)} handles",
+            xaxis={'title': 'handle'},
+            yaxis={'title': 'count'},
+        )
+    }
@@ -0,0 +1,120 @@
+import pickle
+
+import pandas as pd
+from redis.exceptions import RedisError
+
+import compact
+
+
+class HandleStore(object):
+    """
+    Remembers each handle's scored tweets in redis, as chunks in the compact
+    format, so a refresh only has to fetch and score tweets newer than the
+    newest one we already have.  The views and the toxicity graph's point
+    details of the latest lookup are kept with them, so the lookup cache can
+    serve a handle from here without a copy of its own.
+    """
+    # bump the version when the stored fields change
+    prefix = 'handle:v3:'
+
+    def __init__(self, redis_client, ttl=60*60*24):
+        self.redis = redis_client
+        self.ttl = ttl
+
+    def key(self, handle):
+        return self.prefix + handle.lower()
+
+    def get(self, handle):
+        """
+        Returns:
+            tuple: (newest tweet id, scored tweets DataFrame), (None, None) if
+            the handle hasn't been looked up within ttl
+        """
+        chunks = self.chunks(handle)
+        if chunks is None:
+            return None, None
+        tweets_df = compact.decode_chunks(chunks)
+        return int(tweets_df['id'].max()), tweets_df
+
+    def result(self, handle):
+        """
+        Returns:
+            tuple: (chunks, views, points) as stored by put, None if the
+            handle hasn't been looked up within ttl
+        """
+        chunks = self.chunks(handle)
+        if chunks is None:
+            return None
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hget(self.key(handle), 'views')
+            pipe.hmget(self.key(handle), [f'points:{i}' for i in range(len(chunks))])
+            views, points = pipe.execute()
+        except RedisError as e:
+            print(e)
+            return None
+        if views is None or any(chunk is None for chunk in points):
+            return None
+        return chunks, pickle.loads(views), points
+
+    def chunks(self, handle):
+        """
+        Returns:
+            list: the handle's stored chunks, None if there are none
+        """
+        try:
+            count = self.redis.hget(self.key(handle), 'chunks')
+            if count is None:
+                return None
+            chunks = self.redis.hmget(self.key(handle),
+                                      [f'chunk:{i}' for i in range(int(count))])
+        except RedisError as e:
+            print(e)
+            return None
+        if any(chunk is None for chunk in chunks):
+            # replaced by a put in between
+            return None
+        return chunks
+
+    def put(self, handle, chunks, views, points):
+        """
+        Args:
+            handle(str): handle of twitter user in format @handle
+            chunks(:obj:'list' of bytes): the handle's scored tweets, from
+                compact.encode_chunks
+            views(dict): views of them from views.make_views
+            points(:obj:'list' of bytes): their point details, from
+                compact.encode_points
+        """
+        fields = {f'chunk:{i}': chunk for i, chunk in enumerate(chunks)}
+        fields.update((f'points:{i}', chunk) for i, chunk in enumerate(points))
+        fields.update(chunks=len(chunks), views=pickle.dumps(views))
+        try:
+            pipe = self.redis.pipeline()
+            pipe.delete(self.key(handle))
+            pipe.hmset(self.key(handle), fields)
+            pipe.expire(self.key(handle), self.ttl)
+            pipe.execute()
+        except RedisError as e:
+            print(e)
+
+
+def merge_tweets(new_df, old_df, max_tweets=400):
+    """
+    Merge freshly scored tweets into a handle's stored tweets, keeping the
+    newest max_tweets.
+
+    Args:
+        new_df(DataFrame): scored tweets newer than old_df (may be empty)
+        old_df(DataFrame): previously stored scored tweets
+
+    Returns:
+        DataFrame: tweets newest first
+    """
+    if new_df.empty:
+        merged = old_df
+    else:
+        merged = pd.concat([new_df, old_df], ignore_index=True)
+        merged = merged.drop_duplicates('id')
+    merged = merged.sort_values('id', ascending=False)
+    return merged.head(max_tweets).reset_index(drop=True)
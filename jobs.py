@@ -0,0 +1,196 @@
+import json
+import os
+import time
+import uuid
+
+from celery import Celery
+from celery.signals import task_postrun
+from redis.exceptions import RedisError
+
+from metrics import registry
+
+
+redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+celery_app = Celery('jobs', broker=redis_url)
+celery_app.conf.update(task_serializer='json',
+                       accept_content=['json'],
+                       task_ignore_result=True,
+                       task_acks_late=True,
+                       # the redis broker hands an unacknowledged task to
+                       # another worker after visibility_timeout, so it has to
+                       # outlast the longest job (a full batch or deep lookup)
+                       # or that job runs twice at once
+                       broker_transport_options={'visibility_timeout': int(
+                           os.environ.get('JOB_VISIBILITY_TIMEOUT', 60*60*12))},
+                       worker_prefetch_multiplier=1,
+                       # background work gets its own queue and workers, so a
+                       # burst of refreshes never holds up a user's lookup
+                       task_routes={'jobs.refresh': {'queue': 'background'},
+                                    'jobs.warm': {'queue': 'background'}},
+                       beat_schedule={'warm-popular-handles': {
+                           'task': 'jobs.warm',
+                           'schedule': int(os.environ.get('WARM_INTERVAL', 60*10))}})
+
+
+@task_postrun.connect
+def flush_metrics(**kwargs):
+    # a worker can sit idle for a long time after a task, so don't leave its
+    # observations waiting for the next flush interval
+    registry.flush()
+
+
+@celery_app.task
+def lookup(input_value, job_id):
+    """
+    Run a handle lookup on a worker.  Start workers with
+    `celery -A jobs worker`, and workers for refreshes and warm-ups with
+    `celery -A jobs worker -Q background`.
+    """
+    from app import run_lookup
+    run_lookup(input_value, job_id)
+
+
+@celery_app.task
+def batch(handles, job_id):
+    """
+    Run a multi-handle comparison on a worker
+    """
+    from app import run_batch
+    run_batch(handles, job_id)
+
+
+@celery_app.task(bind=True, max_retries=3)
+def refresh(self, handle):
+    """
+    Refresh a handle's cached lookup in the background quota lane, trying
+    again once the lane's quota resets if it is used up
+    """
+    from app import run_refresh
+    from quota import QuotaExhausted
+    try:
+        run_refresh(handle)
+    except QuotaExhausted as e:
+        print(e)
+        raise self.retry(countdown=e.wait)
+
+
+@celery_app.task
+def warm():
+    """
+    Queue refreshes for the most requested handles.  Runs every
+    WARM_INTERVAL seconds under `celery -A jobs beat` (or a worker started
+    with --beat).
+    """
+    from app import warm_popular
+    warm_popular()
+
+
+class Jobs(object):
+    """
+    Registry of submitted lookups so the dashboard can poll a job id for
+    status instead of holding a web worker while the lookup runs.
+
+    Fields:
+        handle: handle being looked up
+        state: queued, running, done, empty or error
+        dataset: key of the final results in the dataset store, once done
+        submitted, finished: unix timestamps
+
+    Batch jobs have `handles` (json list), `completed` (number of handles
+    finished) and `comparison` (json of handle -> level counts so far)
+    instead of handle and dataset.
+    """
+    prefix = 'job:'
+
+    def __init__(self, redis_client, lookups, ttl=60*60):
+        self.redis = redis_client
+        self.lookups = lookups
+        self.ttl = ttl
+
+    def submit(self, handle):
+        """
+        Queue a lookup for handle
+
+        Returns:
+            str: job id
+        """
+        job_id = uuid.uuid4().hex
+        self.update(job_id, handle=handle, state='queued', submitted=time.time())
+        lookup.delay(handle, job_id)
+        return job_id
+
+    def submit_batch(self, handles):
+        """
+        Queue a comparison of several handles
+
+        Returns:
+            str: job id
+        """
+        job_id = uuid.uuid4().hex
+        self.update(job_id, handles=json.dumps(handles), state='queued',
+                    completed=0, submitted=time.time())
+        batch.delay(handles, job_id)
+        return job_id
+
+    def submit_refresh(self, handle):
+        """
+        Queue a background refresh of handle's cached lookup
+        """
+        refresh.delay(handle)
+
+    def update(self, job_id, **fields):
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hmset(self.prefix + job_id, fields)
+            pipe.expire(self.prefix + job_id, self.ttl)
+            pipe.execute()
+        except RedisError as e:
+            print(e)
+
+    def get(self, job_id):
+        """
+        Returns:
+            dict: job fields, empty if the job is unknown or expired
+        """
+        try:
+            job = self.redis.hgetall(self.prefix + job_id)
+        except RedisError as e:
+            print(e)
+            return {}
+        return {k.decode(): v.decode() for k, v in job.items()}
+
+    def active(self, job_ids, grace=5):
+        """
+        Returns:
+            bool: whether any of the jobs is queued, running, or finished less
+            than grace seconds ago, so whoever polls it has seen its last
+            results
+        """
+        if not job_ids:
+            return False
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for job_id in job_ids:
+                pipe.hmget(self.prefix + job_id, ['state', 'finished'])
+            jobs = pipe.execute()
+        except RedisError as e:
+            print(e)
+            return True
+        for state, finished in jobs:
+            if state in (b'queued', b'running'):
+                return True
+            if finished is not None and time.time() - float(finished) < grace:
+                return True
+        return False
+
+    def status(self, job_id):
+        """
+        Job fields plus progress (pages, tweets and latest partial dataset)
+        from the lookup of the job's handle while it is running.
+        """
+        job = self.get(job_id)
+        if job.get('state') == 'running':
+            progress = self.lookups.get(job['handle'])
+            job.update((k, progress[k]) for k in ('pages', 'tweets', 'dataset')
+                       if k in progress)
+        return job
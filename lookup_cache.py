@@ -0,0 +1,118 @@
+import time
+
+from redis.exceptions import RedisError
+
+
+class LookupCache(object):
+    """
+    When each handle was last looked up, and whether it had any tweets.  The
+    tweets themselves are kept by HandleStore; this only decides whether
+    they can be served.  Served stale-while-revalidate: an entry older than
+    `soft_ttl` is still returned, but the caller is told it should be
+    refreshed; only at `hard_ttl` is it dropped.  Refreshes are claimed so
+    that only one runs per handle at a time.
+
+    Also counts how often each handle is requested, decayed over time, so
+    the most popular handles can be kept warm.
+    """
+    # bump the version when the entry's format changes
+    prefix = 'lookup-cache:v3:'
+    popular_key = 'lookup-cache:popular'
+
+    def __init__(self, redis_client, soft_ttl=60*30, hard_ttl=60*60*6,
+                 refresh_timeout=60*10):
+        """
+        Args:
+            soft_ttl(float): seconds before an entry should be refreshed
+            hard_ttl(float): seconds before an entry is dropped
+            refresh_timeout(float): seconds a refresh claim lasts if the
+                refresh never finishes
+        """
+        self.redis = redis_client
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self.refresh_timeout = refresh_timeout
+
+    def key(self, handle):
+        return self.prefix + handle.lower()
+
+    def get(self, handle):
+        """
+        Returns:
+            tuple: (whether the handle had tweets, seconds since it was
+            stored), None on a miss
+        """
+        try:
+            entry = self.redis.get(self.key(handle))
+        except RedisError as e:
+            print(e)
+            return None
+        if entry is None:
+            return None
+        stored_at, found = entry.decode().split(':')
+        return found == '1', time.time() - float(stored_at)
+
+    def put(self, handle, found):
+        """
+        Args:
+            found(bool): whether the lookup found tweets, stored with
+                HandleStore.put
+        """
+        try:
+            pipe = self.redis.pipeline()
+            pipe.set(self.key(handle), f"{time.time()}:{int(found)}",
+                     ex=self.hard_ttl)
+            pipe.delete(self.key(handle) + ':refresh')
+            pipe.execute()
+        except RedisError as e:
+            print(e)
+
+    def is_stale(self, age):
+        return age > self.soft_ttl
+
+    def claim_refresh(self, handle):
+        """
+        Returns:
+            bool: True for the one caller that should refresh handle, until
+            the refresh is stored with put or refresh_timeout passes
+        """
+        try:
+            return bool(self.redis.set(self.key(handle) + ':refresh', 1, nx=True,
+                                       ex=self.refresh_timeout))
+        except RedisError as e:
+            print(e)
+            return False
+
+    def touch(self, handle):
+        """
+        Count a request for handle
+        """
+        try:
+            self.redis.zincrby(self.popular_key, handle.lower(), 1)
+        except RedisError as e:
+            print(e)
+
+    def popular(self, n):
+        """
+        Returns:
+            list: the n most requested handles, most requested first
+        """
+        try:
+            handles = self.redis.zrevrange(self.popular_key, 0, n - 1)
+        except RedisError as e:
+            print(e)
+            return []
+        return [h.decode() for h in handles]
+
+    def decay(self, factor=0.5, floor=0.1):
+        """
+        Scale every handle's request count by factor, dropping handles whose
+        count falls below floor, so popularity follows recent requests
+        """
+        try:
+            pipe = self.redis.pipeline()
+            pipe.zunionstore(self.popular_key, {self.popular_key: factor})
+            pipe.zremrangebyscore(self.popular_key, '-inf', f'({floor}')
+            pipe.execute()
+        except RedisError as e:
+            print(e)
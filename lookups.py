@@ -0,0 +1,54 @@
+from redis.exceptions import RedisError
+
+
+class Lookups(object):
+    """
+    Status of each handle's most recent lookup, kept in redis so whichever
+    worker serves the dashboard's polling can see results as they're
+    published.
+
+    Fields:
+        state: running, done, empty or error
+        dataset: key of the latest (possibly partial) results in the dataset store
+        pages: search pages scored so far
+        tweets: tweets scored so far
+    """
+    prefix = 'lookup:'
+
+    def __init__(self, redis_client, ttl=60*60):
+        self.redis = redis_client
+        self.ttl = ttl
+
+    def key(self, handle):
+        return self.prefix + handle.lower()
+
+    def start(self, handle):
+        try:
+            pipe = self.redis.pipeline()
+            pipe.delete(self.key(handle))
+            pipe.hmset(self.key(handle), {'state': 'running', 'pages': 0, 'tweets': 0})
+            pipe.expire(self.key(handle), self.ttl)
+            pipe.execute()
+        except RedisError as e:
+            print(e)
+
+    def update(self, handle, **fields):
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hmset(self.key(handle), fields)
+            pipe.expire(self.key(handle), self.ttl)
+            pipe.execute()
+        except RedisError as e:
+            print(e)
+
+    def get(self, handle):
+        """
+        Returns:
+            dict: status fields, empty if the handle hasn't been looked up
+        """
+        try:
+            status = self.redis.hgetall(self.key(handle))
+        except RedisError as e:
+            print(e)
+            return {}
+        return {k.decode(): v.decode() for k, v in status.items()}
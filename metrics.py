@@ -0,0 +1,220 @@
+"""
+Counters and histograms for the lookup pipeline, exported in the prometheus
+text format at /metrics.
+
+Every process (gunicorn workers, dash processes, celery workers) buffers its
+observations and adds them to one redis hash every `flush_interval`
+seconds, so /metrics on any web worker shows totals for the whole
+deployment.  Until `registry.bind` is called, e.g. in benchmarks,
+observations stay in the process.
+"""
+import functools
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from redis.exceptions import RedisError
+
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+size_buckets = (1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7)
+series_pattern = re.compile(r'^(\w+)(?:\{(.*)\})?$')
+label_pattern = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+class Registry(object):
+    """
+    The process's metrics, and its buffer of observations not yet added to
+    redis
+    """
+    key = 'metrics:values'
+
+    def __init__(self, flush_interval=5):
+        self.redis = None
+        self.flush_interval = flush_interval
+        self.metrics = OrderedDict()
+        self.pending = defaultdict(float)
+        self.local = defaultdict(float)
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.last_flush = time.time()
+
+    def bind(self, redis_client):
+        """
+        Share observations with every other process through redis
+        """
+        self.redis = redis_client
+
+    def counter(self, name, documentation):
+        return self.register(Counter(self, name, documentation))
+
+    def histogram(self, name, documentation, buckets=latency_buckets):
+        return self.register(Histogram(self, name, documentation, buckets))
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add(self, series, amount):
+        with self.lock:
+            if self.pid != os.getpid():
+                # forked child: what's buffered was the parent's to flush
+                self.pid = os.getpid()
+                self.pending.clear()
+            self.pending[series] += amount
+            due = time.time() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(float)
+            self.last_flush = time.time()
+        if not pending:
+            return
+        if self.redis is None:
+            with self.lock:
+                for series, amount in pending.items():
+                    self.local[series] += amount
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for series, amount in pending.items():
+                pipe.hincrbyfloat(self.key, series, amount)
+            pipe.execute()
+        except RedisError as e:
+            print(e)
+            with self.lock:
+                for series, amount in pending.items():
+                    self.pending[series] += amount
+
+    def values(self):
+        """
+        Returns:
+            dict: series -> value, summed over every process
+        """
+        self.flush()
+        if self.redis is None:
+            with self.lock:
+                return dict(self.local)
+        try:
+            values = self.redis.hgetall(self.key)
+        except RedisError as e:
+            print(e)
+            return {}
+        return {k.decode(): float(v) for k, v in values.items()}
+
+    def render(self):
+        """
+        Returns:
+            str: every metric in the prometheus text exposition format
+        """
+        by_metric = defaultdict(list)
+        for series, value in self.values().items():
+            match = series_pattern.match(series)
+            if match is None:
+                continue
+            name, labels = match.groups()
+            labels = OrderedDict(label_pattern.findall(labels or ''))
+            for metric_name in (name, re.sub(r'_(bucket|sum|count)$', '', name)):
+                if metric_name in self.metrics:
+                    by_metric[metric_name].append((series, name, labels, value))
+                    break
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for series, _, _, value in sorted(by_metric[name], key=metric.sort_key):
+                lines.append(f"{series} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, registry, name, documentation):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+
+    def inc(self, amount=1, **labels):
+        self.registry.add(self.name + format_labels(labels), amount)
+
+    @staticmethod
+    def sort_key(entry):
+        series, name, labels, value = entry
+        return sorted(labels.items())
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, buckets=latency_buckets):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        for bound in self.buckets:
+            if value <= bound:
+                self.registry.add(self.name + '_bucket' +
+                                  format_labels(labels, le=format_value(bound)), 1)
+        self.registry.add(self.name + '_bucket' + format_labels(labels, le='+Inf'), 1)
+        self.registry.add(self.name + '_sum' + format_labels(labels), value)
+        self.registry.add(self.name + '_count' + format_labels(labels), 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the seconds spent in a with block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def timed(self, **labels):
+        """
+        Decorator observing the seconds every call to a function takes
+        """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def sort_key(self, entry):
+        series, name, labels, value = entry
+        other = sorted((k, v) for k, v in labels.items() if k != 'le')
+        suffix = name[len(self.name):]
+        le = labels.get('le')
+        bound = float('inf') if le in (None, '+Inf') else float(le)
+        return other, ('_bucket', '_sum', '_count').index(suffix), bound
+
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    pairs = (f'{k}="{escape(str(v))}"' for k, v in sorted(labels.items()))
+    return '{' + ','.join(pairs) + '}'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+registry = Registry()
@@ -0,0 +1,29 @@
+import os
+import threading
+
+
+class PerProcess(object):
+    """
+    An object built on first use in each process.  Clients holding sockets
+    or threads (a requests session, tweepy's api) are made this way so that
+    importing app.py builds none of them, and a worker forked by
+    `gunicorn --preload` or celery builds its own instead of sharing the
+    parent's.
+    """
+
+    def __init__(self, factory):
+        """
+        Args:
+            factory(function): builds the object, called without arguments
+        """
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.pid = None
+        self.value = None
+
+    def get(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.value = self.factory()
+                self.pid = os.getpid()
+            return self.value
@@ -3,11 +3,88 @@ import requests
 import functools
 import operator
 import asyncio
-from aiohttp import ClientSession
-from datetime import datetime
-import uvloop
+import random
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
 #import concurrent.futures
 
+from dedup import near_duplicates
+from metrics import registry
+from quota import current_lane
+from score_cache import text_hash
+
+
+request_seconds = registry.histogram('perspective_request_seconds',
+                                     'Latency of one perspective request')
+requests_sent = registry.counter('perspective_requests_total',
+                                 'Perspective requests by response status')
+retries = registry.counter('perspective_retries_total',
+                           'Perspective requests retried after a 429, 5xx or connection error')
+failures = registry.counter('perspective_failures_total',
+                            'Texts perspective could not score after every retry')
+dedup_skipped = registry.counter('perspective_dedup_skipped_total',
+                                 'Texts not sent because a near duplicate was scored')
+
+
+class TokenBucket(object):
+    """
+    Token bucket shared by every request a client makes.  Allows `rate`
+    requests per second on average with bursts of up to `capacity`.
+    Tokens are reserved up front so callers just sleep until their slot.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # seconds drain has pushed the schedule back so far
+        self.backoff = 0.0
+        self.backed_off_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token and return how many seconds to wait before using it
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def drain(self):
+        """
+        Back off after the API tells us we're over quota.  Tokens are
+        reserved up front, so the bucket is usually in debt already; rather
+        than emptying it, push the whole schedule back by a full bucket,
+        for the reservations already handed out (see acquire) and the ones
+        to come.  429s to requests sent before that took effect don't push
+        it back again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.backed_off_until:
+                return
+            self.tokens = min(0, self.tokens + (now - self.updated) * self.rate)
+            self.tokens -= self.capacity
+            self.updated = now
+            self.backoff += self.capacity / self.rate
+            self.backed_off_until = now + self.capacity / self.rate
+
+    async def acquire(self):
+        backoff = self.backoff
+        wait = self.reserve()
+        while wait:
+            await asyncio.sleep(wait)
+            # the schedule was pushed back while we slept
+            wait, backoff = self.backoff - backoff, self.backoff
+
 
 class Perspective(object):
     """
@@ -28,12 +105,38 @@ class Perspective(object):
               'SPAM',
               'UNSUBSTANTIAL']
 
-    def __init__(self, key):
+    retry_statuses = {429, 500, 502, 503, 504}
+    max_text_length = 3000
+
+    def __init__(self, key, cache=None, qps=10, max_in_flight=20,
+                 max_retries=5, backoff_base=0.5, backoff_cap=30, base_url=None,
+                 service=None, dedup_threshold=None, quota=None):
+        """
+        Args:
+            cache(ScoreCache): scores to reuse instead of asking the API again
+            qps(int): requests per second budget
+            max_in_flight(int): cap on concurrent requests
+            service(ScoringService): long-lived loop and connection pool to
+                send requests on; without one every batch opens its own
+            dedup_threshold(float): if set, near-duplicate texts at least this
+                similar are scored once per cluster, see dedup.near_duplicates
+            quota(Quota): requests per second budget shared with every other
+                process using the same key
+        """
         self.key = key
+        self.cache = cache
+        self.service = service
+        self.dedup_threshold = dedup_threshold
+        self.quota = quota
+        self.bucket = TokenBucket(qps)
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
         self.s = requests.Session()
         self.headers = {'content-type': 'application/json'}
         self.query_string = {'key': self.key}
-        self.url = self.base_url + '/comments:analyze'
+        self.url = (base_url or self.base_url) + '/comments:analyze'
 
 
     def score(self, text, models=['TOXICITY', 'SEVERE_TOXICITY']):
@@ -51,17 +154,9 @@ class Perspective(object):
              dict: summary scores and span scores for requested models
         """
 
-        key = self.key
-        headers = {'content-type': 'application/json'}
-        query_string = {'key': self.key}
-        url = self.base_url + '/comments:analyze'
-
-        text = text[:3000]
-
-        requested_models = {model: {}
-                             for model in models if model in self.all_models}
-        payload_data = json.dumps(
-            {'comment': {'text': text}, 'requestedAttributes': requested_models})
+        payload_data = self.payload(text, models)
+        if self.quota is not None:
+            self.quota.acquire()
         #response = self.s.send(self.prepped_request)
 
         try:
@@ -74,6 +169,17 @@ class Perspective(object):
             return {'error': e}
         return response.json()
 
+    def payload(self, text, models):
+        """
+        Request body for scoring text, truncated to the 3000 chars we score
+        (scrub_tweets has already truncated tweets, so this only matters for
+        texts that didn't come through it)
+        """
+        requested_models = {model: {}
+                            for model in models if model in self.all_models}
+        return json.dumps({'comment': {'text': text[:self.max_text_length]},
+                           'requestedAttributes': requested_models})
+
     def scores(self, tweets_df, models=['TOXICITY', 'SEVERE_TOXICITY']):
         """
         Same as score but handles a list of texts
@@ -84,62 +190,226 @@ class Perspective(object):
         Returns:
             DataFrame: adds unpacked scores to df it recieves
         """
-        print('scoring...')
-        tweets_df['score'] = tweets_df['scrubbed_text'].apply(self.score)
-
-        for model in models:
-            tweets_df[model + '_score'] = tweets_df['score'].apply(unpack_score,
-                                                                  model_name=model)
-        return categorize_scores(tweets_df)
+        scores = [self.score(text, models) for text in tweets_df['scrubbed_text']]
+        return categorize_scores(add_scores(tweets_df, scores, models))
 
     def async_scores(self, tweets_df, models=['TOXICITY', 'SEVERE_TOXICITY']):
         """
+        Score every scrubbed_text concurrently, within the client's QPS budget.
+        Texts that couldn't be scored get a NaN score and are False in the
+        `scored` column rather than getting a score of 0.
+
+        With a dedup_threshold only one text per cluster of near duplicates
+        is scored and its score is shared by the cluster; the `cluster`
+        column holds the id of the tweet whose text was scored.
+        """
+        texts = tweets_df['scrubbed_text'].values
+        hashes = tweets_df['text_hash'].values if 'text_hash' in tweets_df else None
+        if self.dedup_threshold:
+            representatives = near_duplicates(texts, self.dedup_threshold)
+            scored_rows = np.unique(representatives)
+            dedup_skipped.inc(len(texts) - len(scored_rows))
+            rep_scores = dict(zip(scored_rows, self.cached_scores(
+                texts[scored_rows], models,
+                hashes=None if hashes is None else hashes[scored_rows])))
+            scores = [rep_scores[r] for r in representatives]
+            tweets_df['cluster'] = tweets_df['id'].values[representatives]
+        else:
+            scores = self.cached_scores(texts, models, hashes=hashes)
+            tweets_df['cluster'] = tweets_df['id'].values
+        return categorize_scores(add_scores(tweets_df, scores, models))
+
+    def cached_scores(self, texts, models, hashes=None):
+        """
+        Score texts, only sending texts to the API that aren't already in the
+        score cache.  Duplicate texts within a batch are sent once.
+
+        Args:
+            texts(:obj:'list' of str): scrubbed texts
+            models(:obj:'list' of str): names of perspective models
+            hashes(:obj:'list' of str): text_hash of every text, if the
+                scrub already computed them
+
+        Returns:
+            list: score dicts in the same order as texts
+        """
+        if hashes is None:
+            hashes = [text_hash(t) for t in texts]
+        if self.cache is not None:
+            scores = self.cache.get_many(hashes, models)
+        else:
+            scores = [None] * len(texts)
+
+        unseen = OrderedDict((h, t) for h, t, s in zip(hashes, texts, scores)
+                             if s is None)
+        if unseen:
+            responses = self.run(self.fetch_all, list(unseen.values()), models,
+                                 current_lane())
+            if self.cache is not None:
+                self.cache.set_many(unseen.keys(), models, responses)
+            by_hash = dict(zip(unseen, responses))
+            scores = [by_hash[h] if s is None else s for h, s in zip(hashes, scores)]
+        return scores
+
+    def run(self, coroutine_fn, *args):
         """
+        Run coroutine_fn(*args, session=...) to completion on the scoring
+        service if there is one, otherwise on a new loop and session.
+        """
+        if self.service is not None:
+            return self.service.call(coroutine_fn, *args)
+        import uvloop
         #loop = asyncio.new_event_loop()
         loop = uvloop.new_event_loop()
         asyncio.set_event_loop(loop)
         #loop = asyncio.get_event_loop()
-        future = asyncio.ensure_future(
-            self.fetch_all(tweets_df['scrubbed_text'], models))
-        responses = loop.run_until_complete(future)
-        tweets_df['score'] = [json.loads(r) for r in responses]
-        for model in models:
-            tweets_df[model + '_score'] = tweets_df['score'].apply(unpack_score,
-                                                                  model_name=model)
-        loop.close()
-        return categorize_scores(tweets_df)
-
-    async def fetch(self, text, session, models):
-        text = text[:3000]
-        requested_models = {model: {}
-                            for model in models if model in self.all_models}
-        payload_data = json.dumps(
-            {'comment': {'text': text}, 'requestedAttributes': requested_models})
+        try:
+            return loop.run_until_complete(coroutine_fn(*args))
+        finally:
+            loop.close()
 
-        async with session.post(self.url,
-                                data=payload_data,
-                                headers=self.headers,
-                                params=self.query_string) as response:
-            return await response.read()
+    async def fetch(self, text, session, models, in_flight, lane=None):
+        """
+        Score one text, waiting for a token and an in-flight slot before each
+        attempt.  429s, 5xxs and connection errors are retried with jittered
+        exponential backoff.
 
-    async def fetch_all(self, texts, models):
+        Returns:
+            dict: perspective response, or {'error': {...}} if every attempt failed
         """
-        launch all requests
+        import aiohttp
+        payload_data = self.payload(text, models)
+
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            await self.acquire_quota(lane)
+            retry_after = None
+            try:
+                async with in_flight:
+                    start = time.perf_counter()
+                    async with session.post(self.url,
+                                            data=payload_data,
+                                            headers=self.headers,
+                                            params=self.query_string,
+                                            timeout=30) as response:
+                        status = response.status
+                        body = await response.read()
+                        retry_after = response.headers.get('Retry-After')
+                    request_seconds.observe(time.perf_counter() - start)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, body = None, str(e).encode()
+            requests_sent.inc(status=status or 'connection_error')
+
+            if status == 200:
+                return json.loads(body)
+            if status == 429:
+                self.bucket.drain()
+            if status is not None and status not in self.retry_statuses:
+                break
+            if attempt < self.max_retries:
+                retries.inc()
+                await asyncio.sleep(self.backoff(attempt, retry_after))
+
+        failures.inc()
+        return {'error': {'status': status,
+                          'message': body.decode('utf-8', 'replace')[:500]}}
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Full-jitter exponential backoff, never shorter than Retry-After
+        """
+        delay = random.uniform(0, min(self.backoff_cap,
+                                      self.backoff_base * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        return delay
+
+    async def acquire_quota(self, lane):
+        """
+        Wait for a request from the shared quota, if there is one.  The redis
+        round trip is short enough to make on the loop (an executor thread
+        would be a greenlet under gevent).
+        """
+        if self.quota is None:
+            return
+        wait = self.quota.reserve(lane)
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.quota.reserve(lane)
+
+    async def fetch_all(self, texts, models, lane=None, session=None):
+        """
+        launch all requests, at most max_in_flight at a time, on session or
+        on a session opened just for this batch.  Requests are made in the
+        given quota lane.
+
+        Returns:
+            list: responses in the same order as texts
         """
-        tasks = []
-        async with ClientSession() as session:
-            for t in texts:
-                task = asyncio.ensure_future(self.fetch(t, session, models))
-                tasks.append(task)
-            return await asyncio.gather(*tasks)
+        if session is None:
+            from aiohttp import ClientSession
+            async with ClientSession() as session:
+                return await self.fetch_all(texts, models, lane, session)
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        tasks = [self.fetch(t, session, models, in_flight, lane) for t in texts]
+        return await asyncio.gather(*tasks)
 
 
+def add_scores(tweets_df, scores, models):
+    """
+    Adds a <MODEL>_score column per model and a boolean `scored` mask to
+    tweets DataFrame.  Failures are logged with the first error seen.
+
+    Args:
+        tweets_df(DataFrame): tweets in the same order as scores
+        scores(list): perspective responses, or {'error': ...} dicts
+        models(:obj:'list' of str): names of models to unpack
+
+    Returns:
+        DataFrame: tweets_df with score columns added
+    """
+    model_scores, scored = unpack_scores(scores, models)
+    for model in models:
+        tweets_df[model + '_score'] = model_scores[model]
+    tweets_df['scored'] = scored
+    if not scored.all():
+        first_failure = scores[int(np.argmin(scored))]
+        print(f"{len(scored) - scored.sum()} of {len(scored)} tweets could not be "
+              f"scored, e.g. {score_error(first_failure)}")
+    return tweets_df
+
+def unpack_scores(scores, models):
+    """
+    Pulls every requested model's summary score out of a list of score json
+    in a single pass.  If perspective couldn't score text, NaN is used.
+
+    Args:
+        scores(list): complete score json for each tweet
+        models(:obj:'list' of str): names of models to unpack
+
+    Returns:
+        tuple: dict of model name -> float64 array of percentage scores,
+        and a boolean array that is True where the text was scored
+    """
+    values = np.full((len(models), len(scores)), np.nan)
+    scored = np.zeros(len(scores), dtype=bool)
+    for i, score in enumerate(scores):
+        attributes = score.get('attributeScores')
+        if attributes:
+            scored[i] = True
+            for m, model in enumerate(models):
+                values[m, i] = attributes[model]['summaryScore']['value']
+    values = np.round(values * 100)
+    return {model: values[m] for m, model in enumerate(models)}, scored
+
 def categorize_scores(tweets_df):
     """
     Adds toxicity category, display, and datetime info to tweets DataFrame
 
     Returns:
         Returns: tweets_df with boolean toxicity category columns: low, med, high
+        (tweets that couldn't be scored are in none of them), a `created`
+        datetime column, display_time and screen_name
     """
     TOX_THRESH = 90
     SEV_TOX_THRESH = 65
@@ -147,30 +417,34 @@ def categorize_scores(tweets_df):
     tweets_df['MED_LEVEL'] = ((tweets_df['TOXICITY_score'] > TOX_THRESH) &
                                 (tweets_df['SEVERE_TOXICITY_score'] < SEV_TOX_THRESH))
     tweets_df['HI_LEVEL'] = tweets_df['SEVERE_TOXICITY_score'] > SEV_TOX_THRESH
-    tweets_df['display_time'] = tweets_df['created_at'].apply(format_time)
-    tweets_df['screen_name'] = tweets_df['user'].apply(lambda t: t['screen_name'])
+    tweets_df['created'] = pd.to_datetime(tweets_df['created_at'],
+                                          format='%a %b %d %H:%M:%S +0000 %Y')
+    tweets_df['display_time'] = format_times(tweets_df['created'].values)
+    tweets_df['screen_name'] = tweets_df['user'].map(operator.itemgetter('screen_name'))
     return tweets_df
 
-def format_time(time_stamp):
-    d = datetime.strptime(time_stamp, '%a %b %d %H:%M:%S +0000 %Y')
-    return d.strftime("%a %B %d %I:%M%p")
-
-def unpack_score(score, **kwargs):
+def format_times(times):
     """
-    Pulls specific model score out of score json.
-    If perspective can't score text, 0 is used.
+    Format datetime64 values for display.  Display times only have minute
+    resolution, so each distinct minute is formatted once.
 
     Args:
-        score(dict): complete score json for a tweet
-        kwargs: name of the model to unpack score
+        times(ndarray): datetime64 values
 
     Returns:
-        model_score: integer that represents percentage score for a given model
+        ndarray: strings like 'Mon April 02 09:15PM'
+    """
+    minutes, inverse = np.unique(times.astype('datetime64[m]'), return_inverse=True)
+    formatted = pd.DatetimeIndex(minutes).strftime("%a %B %d %I:%M%p")
+    return np.asarray(formatted, dtype=object)[inverse]
+
+def score_error(score):
+    """
+    Pulls the error message out of a failed score, None if it was scored
     """
-    model_name = kwargs.get('model_name')
     if 'attributeScores' in score:
-        model_score = round(
-        score['attributeScores'][model_name]['summaryScore']['value'] * 100)
-    else:
-        model_score = 0
-    return model_score
+        return None
+    error = score.get('error', {})
+    if not isinstance(error, dict):
+        return str(error)
+    return f"{error.get('status')}: {error.get('message')}"
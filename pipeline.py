@@ -0,0 +1,71 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from metrics import registry
+from quota import current_lane, in_lane
+
+
+first_page_seconds = registry.histogram(
+    'lookup_first_page_seconds', 'Time from starting a lookup to its first scored page')
+lookup_seconds = registry.histogram(
+    'lookup_seconds', 'Time to fetch and score every page of a lookup')
+lookup_pages = registry.counter('lookup_pages_total', 'Search pages fetched and scored')
+
+
+def score_pages(twitter_client, perspective_client, handle, since_id=None,
+                on_page=None, max_tweets=400, publish_interval=2,
+                publish_growth=1.5):
+    """
+    Fetch and score tweets at a handle page by page.  The next search page is
+    fetched on a background thread while the current one is being scored,
+    so a lookup takes about as long as the slower of the two instead of
+    their sum.
+
+    Args:
+        twitter_client(Twitter)
+        perspective_client(Perspective)
+        handle(str): handle of twitter user in format @handle
+        since_id(int): only get tweets newer than this id
+        on_page(callable): called with all tweets scored so far after the
+            first page, then at most every publish_interval seconds and only
+            once publish_growth times as many tweets have been scored as
+            last time, so publishing costs O(tweets) over a whole lookup
+        max_tweets(int): max number of tweets to get
+
+    Returns:
+        DataFrame: scored tweets, newest first (empty if there were none)
+    """
+    start = time.perf_counter()
+    pages = twitter_client.pages_at(handle, max_tweets, since_id=since_id)
+    scored = []
+    published = None
+    published_rows = 0
+    scored_rows = 0
+    # searches made on the fetcher thread count against the caller's lane
+    lane = current_lane()
+    with ThreadPoolExecutor(max_workers=1) as fetcher:
+        next_page = fetcher.submit(in_lane, lane, next, pages, None)
+        while True:
+            page = next_page.result()
+            if page is None:
+                break
+            next_page = fetcher.submit(in_lane, lane, next, pages, None)
+            scored.append(perspective_client.async_scores(page))
+            scored_rows += len(scored[-1])
+            lookup_pages.inc()
+            if len(scored) == 1:
+                first_page_seconds.observe(time.perf_counter() - start)
+            now = time.perf_counter()
+            if on_page is not None and (published is None or
+                                        (now - published >= publish_interval and
+                                         scored_rows >= published_rows * publish_growth)):
+                on_page(pd.concat(scored, ignore_index=True))
+                published = now
+                published_rows = scored_rows
+
+    lookup_seconds.observe(time.perf_counter() - start)
+    if not scored:
+        return pd.DataFrame()
+    return pd.concat(scored, ignore_index=True)
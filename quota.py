@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from redis.exceptions import RedisError
+
+
+# share of a quota each lane may use; lower lanes stop early so there is
+# always headroom left for interactive lookups
+lanes = OrderedDict([('interactive', 1.0),
+                     ('background', 0.5)])
+local = threading.local()
+
+
+class QuotaExhausted(Exception):
+    """
+    Raised instead of waiting when a lane that doesn't wait long has used
+    up its share, so a background job can be retried later rather than
+    hold its worker while it sleeps
+    """
+
+    def __init__(self, name, lane, wait):
+        super().__init__(f"{name} quota used up for the {lane} lane for {wait:.1f}s")
+        self.wait = wait
+
+take_script = """
+local count = tonumber(redis.call('GET', KEYS[1]) or '0')
+if count >= tonumber(ARGV[1]) then
+    local ttl = redis.call('PTTL', KEYS[1])
+    if ttl < 0 then
+        redis.call('PEXPIRE', KEYS[1], ARGV[2])
+        ttl = tonumber(ARGV[2])
+    end
+    return ttl
+end
+if redis.call('INCR', KEYS[1]) == 1 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class Quota(object):
+    """
+    A budget of `limit` API calls per `window` seconds shared through redis
+    by every process and thread that uses the same name, so gunicorn
+    workers, dash processes and celery workers draw from one count instead
+    of each assuming it has the whole key to itself.
+
+    Calls are made in a lane (see `lanes` and `priority`); a lane can only
+    use its share of each window.  Interactive calls wait for the next
+    window; calls in other lanes only wait up to max_wait seconds and
+    raise QuotaExhausted otherwise.  If redis is unavailable calls aren't
+    held back, leaving the clients' own rate limiting to cope.
+    """
+    prefix = 'quota:'
+
+    def __init__(self, redis_client, name, limit, window, max_wait=5):
+        """
+        Args:
+            name(str): what is being budgeted, e.g. twitter:search
+            limit(int): calls allowed per window
+            window(float): seconds
+            max_wait(float): longest wait for a call outside the interactive
+                lane
+        """
+        self.redis = redis_client
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.max_wait = max_wait
+        self.key = self.prefix + name
+        self.take = redis_client.register_script(take_script)
+
+    def reserve(self, lane=None):
+        """
+        Take one call from the current window if the lane has any left.
+
+        Returns:
+            float: 0 if the call may go ahead, otherwise seconds until the
+            window resets
+        """
+        lane_limit = max(1, int(self.limit * lanes[lane or current_lane()]))
+        try:
+            wait_ms = self.take(keys=[self.key],
+                                args=[lane_limit, int(self.window * 1000)])
+        except RedisError as e:
+            print(e)
+            return 0
+        return wait_ms / 1000
+
+    def acquire(self, lane=None):
+        """
+        Block until a call is available
+
+        Raises:
+            QuotaExhausted: outside the interactive lane, if that would take
+                longer than max_wait
+        """
+        lane = lane or current_lane()
+        wait = self.reserve(lane)
+        while wait:
+            if lane != 'interactive' and wait > self.max_wait:
+                raise QuotaExhausted(self.name, lane, wait)
+            print(f"{self.name} quota used up for the {lane} lane, waiting {wait:.1f}s")
+            time.sleep(wait)
+            wait = self.reserve(lane)
+
+    def available(self, lane=None):
+        """
+        Returns:
+            int: calls the lane has left in the current window (the lane's
+            full share if redis can't be reached)
+        """
+        lane_limit = max(1, int(self.limit * lanes[lane or current_lane()]))
+        return max(0, lane_limit - self.usage().get('used', 0))
+
+    def usage(self):
+        """
+        Returns:
+            dict: calls used and allowed in the current window, and seconds
+            until it resets
+        """
+        try:
+            pipe = self.redis.pipeline()
+            pipe.get(self.key)
+            pipe.pttl(self.key)
+            used, ttl = pipe.execute()
+        except RedisError as e:
+            print(e)
+            return {}
+        return {'used': int(used or 0),
+                'limit': self.limit,
+                'resets_in': max(ttl, 0) / 1000}
+
+
+def current_lane():
+    return getattr(local, 'lane', 'interactive')
+
+
+@contextmanager
+def priority(lane):
+    """
+    Make quota calls on this thread in lane, e.g.
+
+        with priority('background'):
+            global_store(handle)
+    """
+    previous = current_lane()
+    local.lane = lane
+    try:
+        yield
+    finally:
+        local.lane = previous
+
+
+def in_lane(lane, fn, *args):
+    """
+    Call fn(*args) in lane, e.g. on a pool thread working for a caller in
+    that lane
+    """
+    with priority(lane):
+        return fn(*args)
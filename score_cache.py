@@ -0,0 +1,164 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+from metrics import registry
+
+
+score_lookups = registry.counter('score_cache_lookups_total',
+                                'Score cache lookups by where the score was found')
+
+
+class ScoreCache(object):
+    """
+    Content addressed cache for Perspective scores.
+
+    Scores are keyed by the requested models and a hash of the scrubbed text
+    (computed once, when the tweet is scrubbed) so the same reply showing up
+    under several handles is only ever scored once.  A small in-process LRU
+    sits in front of redis; redis entries expire after `ttl` seconds and
+    should be run with an eviction policy such as `volatile-lru` so the cache
+    can't push the cached lookups and stored handles out.
+    """
+    prefix = 'score:'
+    stats_key = 'score:stats'
+
+    def __init__(self, redis_client=None, lru_size=10000, ttl=60*60*24*7):
+        self.redis = redis_client
+        self.lru_size = lru_size
+        self.ttl = ttl
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = {'lru_hits': 0, 'redis_hits': 0, 'misses': 0}
+
+    @staticmethod
+    def make_key(content_hash, models):
+        """
+        Args:
+            content_hash(str): text_hash of the text exactly as it will be
+                sent to perspective
+            models(:obj:'list' of str): names of requested models
+
+        Returns:
+            str: key identifying the (text, models) pair
+        """
+        return f"{','.join(sorted(models))}:{content_hash}"
+
+    def get_many(self, hashes, models):
+        """
+        Look up scores for a list of texts by their text_hash.
+
+        Returns:
+            list: cached score dict or None for every hash, in input order
+        """
+        keys = [self.make_key(h, models) for h in hashes]
+        results = [None] * len(keys)
+        missing = []
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.lru:
+                    self.lru.move_to_end(key)
+                    results[i] = self.lru[key]
+                else:
+                    missing.append(i)
+        lru_hits = len(keys) - len(missing)
+
+        redis_hits = 0
+        if missing and self.redis is not None:
+            try:
+                values = self.redis.mget([self.prefix + keys[i] for i in missing])
+            except RedisError as e:
+                print(e)
+                values = [None] * len(missing)
+            found = {}
+            for i, value in zip(missing, values):
+                if value is not None:
+                    results[i] = json.loads(value)
+                    found[keys[i]] = results[i]
+            redis_hits = len(found)
+            self._remember(found)
+
+        self._count(lru_hits, redis_hits, len(missing) - redis_hits)
+        return results
+
+    def set_many(self, hashes, models, scores):
+        """
+        Store successful scores.  Error responses are never cached.
+        """
+        entries = {}
+        for content_hash, score in zip(hashes, scores):
+            if score and 'attributeScores' in score:
+                entries[self.make_key(content_hash, models)] = compact_score(score)
+        if not entries:
+            return
+        self._remember(entries)
+        if self.redis is not None:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for key, score in entries.items():
+                    pipe.set(self.prefix + key, json.dumps(score), ex=self.ttl)
+                pipe.execute()
+            except RedisError as e:
+                print(e)
+
+    def stats(self):
+        """
+        Hit/miss counts for this process and, when redis is available,
+        summed over every process sharing the cache.
+        """
+        with self.lock:
+            local = dict(self.counts, lru_size=len(self.lru))
+        stats = {'local': local}
+        if self.redis is not None:
+            try:
+                shared = self.redis.hgetall(self.stats_key)
+                stats['shared'] = {k.decode(): int(v) for k, v in shared.items()}
+            except RedisError as e:
+                print(e)
+        return stats
+
+    def _remember(self, entries):
+        with self.lock:
+            for key, score in entries.items():
+                self.lru[key] = score
+                self.lru.move_to_end(key)
+            while len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+
+    def _count(self, lru_hits, redis_hits, misses):
+        score_lookups.inc(lru_hits, result='lru_hit')
+        score_lookups.inc(redis_hits, result='redis_hit')
+        score_lookups.inc(misses, result='miss')
+        with self.lock:
+            self.counts['lru_hits'] += lru_hits
+            self.counts['redis_hits'] += redis_hits
+            self.counts['misses'] += misses
+        if self.redis is not None:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.hincrby(self.stats_key, 'lru_hits', lru_hits)
+                pipe.hincrby(self.stats_key, 'redis_hits', redis_hits)
+                pipe.hincrby(self.stats_key, 'misses', misses)
+                pipe.execute()
+            except RedisError as e:
+                print(e)
+
+
+def compact_score(score):
+    """
+    Strip span scores and metadata from a perspective response, keeping only
+    what unpack_scores reads.
+    """
+    return {'attributeScores': {
+        model: {'summaryScore': {'value': s['summaryScore']['value']}}
+        for model, s in score['attributeScores'].items()}}
+
+
+def text_hash(text):
+    """
+    Content hash of a scrubbed text, used for score cache keys
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
@@ -0,0 +1,151 @@
+import _thread
+import asyncio
+import atexit
+import os
+import threading
+
+
+
+class ScoringService(object):
+    """
+    One long-lived event loop per process, running on its own OS thread, with
+    a keep-alive connection pool and DNS cache shared by every request the
+    process sends.  Any thread (or greenlet) can submit coroutines to it.
+
+    Nothing is started until the first submit, and a submit from a process
+    whose pid doesn't match the one that started the loop (i.e. a child
+    forked by `gunicorn --preload` or celery) starts a fresh loop and pool,
+    so sockets are never shared across processes.  The session is closed
+    when the process exits (or on close).
+    """
+
+    def __init__(self, limit=100, dns_ttl=300, keepalive_timeout=30):
+        self.limit = limit
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.lock = threading.Lock()
+        self.pid = None
+        self.loop = None
+        self.session = None
+
+    def submit(self, coroutine_fn, *args):
+        """
+        Schedule coroutine_fn(*args, session=<pooled ClientSession>) on the
+        service's loop.
+
+        Returns:
+            concurrent.futures.Future: the coroutine's result
+        """
+        loop = self._loop()
+        return asyncio.run_coroutine_threadsafe(self._call(coroutine_fn, args), loop)
+
+    def call(self, coroutine_fn, *args):
+        """
+        Same as submit but waits for and returns the result.  Under gevent
+        only the calling greenlet waits.
+        """
+        future = self.submit(coroutine_fn, *args)
+        return wait(future)
+
+    def close(self):
+        """
+        Close the pooled session and stop this process's loop, if it started
+        one.  The next submit starts them again.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            loop = self.loop
+            self.pid = None
+            self.loop = None
+        try:
+            wait(asyncio.run_coroutine_threadsafe(self._close(), loop))
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+
+    def _loop(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # first use, or we're a forked child holding the parent's loop
+                import uvloop
+                self.loop = uvloop.new_event_loop()
+                self.session = None
+                self.pid = os.getpid()
+                start_os_thread(self._run, self.loop)
+                atexit.register(self.close)
+            return self.loop
+
+    @staticmethod
+    def _run(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+        loop.close()
+
+    async def _close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _call(self, coroutine_fn, args):
+        if self.session is None:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             use_dns_cache=True,
+                                             ttl_dns_cache=self.dns_ttl,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return await coroutine_fn(*args, session=self.session)
+
+
+def gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def start_os_thread(target, *args):
+    """
+    Start a real OS thread even when gevent has patched threading into
+    greenlets, so the event loop doesn't block the gevent hub.
+    """
+    start_new_thread = _thread.start_new_thread
+    if gevent_patched():
+        from gevent import monkey
+        start_new_thread = monkey.get_original('_thread', 'start_new_thread')
+    start_new_thread(target, args)
+
+
+def wait(future):
+    """
+    Returns:
+        the result of a future completed on the service's loop, waiting
+        only in the current greenlet under gevent
+    """
+    if gevent_patched():
+        wait_from_greenlet(future)
+    return future.result()
+
+
+def wait_from_greenlet(future):
+    """
+    Block only the current greenlet until a future completed on another OS
+    thread, using a hub async watcher (gevent locks can't be released
+    across threads).  The watcher is started before the future can signal
+    it, since starting it clears a signal sent earlier.
+    """
+    from gevent import get_hub
+    from gevent.hub import Waiter
+    hub = get_hub()
+    # gevent < 1.3 spells it loop.async, which is a keyword from python 3.7
+    make_watcher = getattr(hub.loop, 'async_', None) or getattr(hub.loop, 'async')
+    watcher = make_watcher()
+    waiter = Waiter()
+    watcher.start(waiter.switch, None)
+    try:
+        future.add_done_callback(lambda f: watcher.send())
+        if not future.done():
+            waiter.get()
+    finally:
+        watcher.stop()
@@ -0,0 +1,145 @@
+import pickle
+import threading
+import time
+import uuid
+
+from redis.exceptions import RedisError
+
+
+renew_script = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+release_script = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight(object):
+    """
+    Runs at most one call per key at a time across every process sharing
+    redis.  The first caller takes a lease on the key and runs the call;
+    callers that arrive while it's running wait for its result instead of
+    repeating the work.
+
+    The owner renews its lease while the call runs, so the lease only lapses
+    if the owner dies, and then the next waiter takes over.  Waiters wait
+    for as long as the lease is held, however long the call takes.
+    """
+    prefix = 'flight:'
+
+    def __init__(self, redis_client, lease_ttl=30, poll_interval=0.5,
+                 result_ttl=60):
+        """
+        Args:
+            lease_ttl(float): seconds a lease outlives its last renewal
+            poll_interval(float): seconds between checks while waiting
+            result_ttl(float): seconds a result is kept for waiters to pick up
+        """
+        self.redis = redis_client
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+        self.renew = redis_client.register_script(renew_script)
+        self.release = redis_client.register_script(release_script)
+
+    def run(self, key, fn, *args):
+        """
+        Returns:
+            fn(*args), computed here or by whoever held the lease on key
+        """
+        token = uuid.uuid4().hex
+        while True:
+            try:
+                acquired = self.acquire(key, token)
+            except RedisError as e:
+                print(e)
+                return fn(*args)
+            if acquired:
+                return self.own(key, token, fn, args)
+
+            found, result = self.wait(key)
+            if found:
+                print(f"shared result of a concurrent call for {key}")
+                return result
+            print(f"lease on {key} lapsed without a result, taking over")
+
+    def acquire(self, key, token):
+        """
+        Take the lease on key if nobody holds it, clearing the result of the
+        previous call
+
+        Returns:
+            bool: whether the lease was taken
+        """
+        acquired = self.redis.set(self.lease_key(key), token, nx=True,
+                                  px=int(self.lease_ttl * 1000))
+        if acquired:
+            self.redis.delete(self.result_key(key))
+        return bool(acquired)
+
+    def own(self, key, token, fn, args):
+        """
+        Run the call, renewing the lease until it returns, then hand the
+        result to any waiters
+        """
+        done = threading.Event()
+        renewer = threading.Thread(target=self.keep_lease, args=(key, token, done),
+                                   daemon=True)
+        renewer.start()
+        try:
+            result = fn(*args)
+            try:
+                self.redis.set(self.result_key(key), pickle.dumps(result),
+                               px=int(self.result_ttl * 1000))
+            except RedisError as e:
+                print(e)
+            return result
+        finally:
+            done.set()
+            try:
+                self.release(keys=[self.lease_key(key)], args=[token])
+            except RedisError as e:
+                print(e)
+
+    def keep_lease(self, key, token, done):
+        while not done.wait(self.lease_ttl / 3):
+            try:
+                self.renew(keys=[self.lease_key(key)],
+                           args=[token, int(self.lease_ttl * 1000)])
+            except RedisError as e:
+                print(e)
+
+    def wait(self, key):
+        """
+        Wait for the lease holder's result.
+
+        Returns:
+            tuple: (True, result) once there is one, (False, None) if the
+            lease was released or lapsed without one
+        """
+        while True:
+            try:
+                pipe = self.redis.pipeline()
+                pipe.get(self.result_key(key))
+                pipe.exists(self.lease_key(key))
+                result, leased = pipe.execute()
+            except RedisError as e:
+                print(e)
+                return False, None
+            if result is not None:
+                return True, pickle.loads(result)
+            if not leased:
+                return False, None
+            time.sleep(self.poll_interval)
+
+    def lease_key(self, key):
+        return self.prefix + key + ':lease'
+
+    def result_key(self, key):
+        return self.prefix + key + ':result'
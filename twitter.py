@@ -1,10 +1,23 @@
+import html
 import json
+import math
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 
-import tweepy
 import pandas as pd
 
+from metrics import registry
+from quota import current_lane, in_lane
+from score_cache import text_hash
+
+search_seconds = registry.histogram('twitter_search_seconds',
+                                    'Latency of one twitter search call')
+tweets_fetched = registry.counter('twitter_tweets_fetched_total',
+                                  'Tweets returned by twitter search')
+scrub_seconds = registry.histogram('scrub_seconds',
+                                   'Time to scrub one page of tweets')
+
 #from tweepy.streaming import StreamListener
 #from tweepy import OAuthHandler
 #from tweepy import Stream
@@ -14,68 +27,251 @@ class Twitter(object):
     Basic client for twitter API on top of tweepy
     """
     retweet_filter='-filter:retweets'
+    tweets_per_qry = 100
+    # how much further back than the first page's density suggests the
+    # parallel slices reach, so the serial tail fetch is rarely needed
+    span_margin = 1.5
 
-    def __init__(self, consumer_key, consumer_secret):
+    def __init__(self, consumer_key, consumer_secret, api=None, slices=1,
+                 max_workers=4, quota=None):
+        """
+        Args:
+            api: object with tweepy.API's search method to use instead of
+                 authenticating with twitter, e.g. a local stand-in for benchmarks
+            slices(int): id ranges to search in parallel after the first page,
+                 1 to page serially
+            max_workers(int): searches running at once when slices > 1
+            quota(Quota): search calls per window shared with every other
+                 process using the same app credentials
+        """
+        self.slices = slices
+        self.max_workers = max_workers
+        self.quota = quota
+        if api is not None:
+            self.api = api
+            return
+        # only processes that search need tweepy
+        import tweepy
         self.auth = tweepy.AppAuthHandler(consumer_key, consumer_secret)
         self.auth.secure = True
         self.api = tweepy.API(self.auth,
                               wait_on_rate_limit=True,
                               wait_on_rate_limit_notify=True)
 
-    def tweets_at(self, handle, max_tweets=400):
+    def tweets_at(self, handle, max_tweets=400, since_id=None):
         """
         Get tweets at a @handle.  Retweets of that @handle are filtered out.
 
         Args:
             handle(str): handle of twitter user in format @handle
             max_tweets(int): max number of tweets to get
+            since_id(int): only get tweets newer than this id
 
         Returns:
-            list: Tweepy Status objects
+            DataFrame: scrubbed tweets, newest first
+        """
+        pages = list(self.pages_at(handle, max_tweets, since_id))
+        if not pages:
+            return pd.DataFrame()
+        return pd.concat(pages, ignore_index=True)
+
+    def pages_at(self, handle, max_tweets=400, since_id=None):
+        """
+        Same as tweets_at but yields each page of search results as soon as
+        it arrives so it can be scored while the next page is fetched.
+        Serial and sliced searches yield the same tweets: the newest
+        max_tweets, in id order.
+
+        Yields:
+            DataFrame: scrubbed tweets for one page, newest first
         """
         search_query = handle + self.retweet_filter
-        max_id = -1
-        tweets_per_qry = 100
-        since_id = None
+        if self.slices > 1:
+            pages = self.sliced_search(search_query, max_tweets, since_id)
+        else:
+            pages = self.search_pages(search_query, max_tweets, since_id)
+        for new_tweets in pages:
+            tweets_df = pd.DataFrame(t._json for t in new_tweets)
+            yield scrub_tweets(tweets_df)
+
+    def search_pages(self, search_query, max_tweets, since_id=None, max_id=None):
+        """
+        Page serially through search results in (since_id, max_id], newest
+        first, stopping after max_tweets.
+
+        Yields:
+            list: statuses of one page
+        """
         tweet_count = 0
-        tweets = []
         while tweet_count < max_tweets:
-            if (max_id <= 0):
-                new_tweets = self.api.search(q=search_query,
-                                             count=tweets_per_qry,
-                                             tweet_mode='extended')
-            else:
-                new_tweets = self.api.search(q=search_query,
-                                             count=tweets_per_qry,
-                                             tweet_mode='extended',
-                                             max_id=str(max_id - 1))
+            new_tweets = self.search(search_query, since_id, max_id)
             if not new_tweets:
                 print("No more tweets found")
                 break
+            new_tweets = new_tweets[:max_tweets - tweet_count]
             tweet_count += len(new_tweets)
-            max_id = new_tweets[-1].id
-            tweets.extend(new_tweets)
-        tweets_df = pd.DataFrame(t._json for t in tweets)
-        tweets_df = scrub_tweets(tweets_df)
-        return tweets_df
+            max_id = new_tweets[-1].id - 1
+            yield new_tweets
+
+    def sliced_search(self, search_query, max_tweets, since_id=None):
+        """
+        Same as search_pages, but after the first page the ids older than it
+        are split into disjoint slices that are searched concurrently.  How
+        far back the slices reach is estimated from the span of ids on the
+        first page, and each slice fetches at most its share of the tweets
+        still wanted, so a lookup makes about as many search calls as
+        paging serially would.  If a slice fills its share before running
+        out of tweets, the slices older than it are dropped and the rest is
+        paged serially from where it stopped, as it is if the slices fall
+        short.
+
+        Yields:
+            list: statuses of the first page, then of each slice in id order
+        """
+        first = self.search(search_query, since_id)[:max_tweets]
+        if not first:
+            print("No more tweets found")
+            return
+        yield first
+        remaining = max_tweets - len(first)
+        if remaining <= 0:
+            return
+
+        floor = first[-1].id - 1
+        span = int(max(first[0].id - first[-1].id, 1) * self.span_margin *
+                   remaining / len(first))
+        slices = id_slices(floor, span, self.slices, since_id)
+        if not slices:
+            yield from self.search_pages(search_query, remaining, since_id, floor)
+            return
+        pages = math.ceil(remaining * self.span_margin / len(slices) /
+                          self.tweets_per_qry)
+        share = pages * self.tweets_per_qry
+        seen = {t.id for t in first}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            lane = current_lane()
+            futures = [pool.submit(in_lane, lane, self.search_all, search_query,
+                                   share, *s)
+                       for s in slices]
+            for (low, high), future in zip(slices, futures):
+                if remaining <= 0 or floor != high:
+                    # done, or an earlier slice was cut short
+                    future.cancel()
+                    continue
+                statuses = future.result()
+                new_tweets = [t for t in statuses if t.id not in seen][:remaining]
+                if new_tweets:
+                    remaining -= len(new_tweets)
+                    seen.update(t.id for t in new_tweets)
+                    yield new_tweets
+                floor = statuses[-1].id - 1 if len(statuses) >= share else low
+
+        if remaining > 0 and floor > (since_id or 0):
+            yield from self.search_pages(search_query, remaining, since_id, floor)
+
+    def search_all(self, search_query, max_tweets, since_id=None, max_id=None):
+        """
+        Returns:
+            list: every status search_pages yields
+        """
+        return [t for page in self.search_pages(search_query, max_tweets,
+                                                since_id, max_id)
+                for t in page]
+
+    def search(self, search_query, since_id=None, max_id=None):
+        """
+        One page of search results in (since_id, max_id], newest first
+        """
+        if self.quota is not None:
+            self.quota.acquire()
+        search_args = {}
+        if since_id:
+            search_args['since_id'] = str(since_id)
+        if max_id:
+            search_args['max_id'] = str(max_id)
+        with search_seconds.time():
+            new_tweets = self.api.search(q=search_query,
+                                         count=self.tweets_per_qry,
+                                         tweet_mode='extended',
+                                         **search_args)
+        tweets_fetched.inc(len(new_tweets))
+        return new_tweets
+
+
+def id_slices(max_id, span, count, since_id=None):
+    """
+    Split the ids (max_id - span, max_id], but none at or below since_id,
+    into count disjoint ranges.  Tweet ids grow with time, so these are
+    also time slices.
+
+    Returns:
+        list: (since_id, max_id) pairs, newest first
+    """
+    floor = max(max_id - span, since_id or 0)
+    step = max((max_id - floor) // count, 1)
+    bounds = ([max_id] + [max(max_id - step * i, floor) for i in range(1, count)] +
+              [floor])
+    return [(low, high) for high, low in zip(bounds, bounds[1:]) if high > low]
+
+removed_entities = ('user_mentions', 'hashtags', 'urls', 'media')
+# same limit as Perspective.max_text_length, so the hash is of what gets scored
+max_text_length = 3000
+# only for tweets that come without entities
+fallback_scrub_pattern = re.compile(r'[@#]\w+|https?://\S+')
+
 
-compiled_scrub_pattern = re.compile(r'(?<![#@])\b\w+\b')
 def scrub_tweets(tweets):
         """
-        Currently just strips @mentions and #hashtags out of full_text field of
-        tweepy Status object
+        Normalizes the full_text field of tweepy Status objects for scoring in
+        a single pass per tweet: @mentions, #hashtags, urls and media links are
+        cut out using the entity offsets twitter sends with every tweet, html
+        escapes are undone, whitespace is folded and the text is truncated to
+        what perspective will score.  A content hash of the result is added
+        for the score cache to key on.
 
         Args:
             tweets(dataframe)
 
         Returns:
-            tweets(dataframe)
+            tweets(dataframe): with scrubbed_text and text_hash columns
         """
-        print('scrubbing...!')
-        tweets['scrubbed_text'] = tweets['full_text'].apply(scrub_tweet)
+        with scrub_seconds.time():
+            if 'entities' in tweets:
+                entities = tweets['entities'].values
+            else:
+                entities = [None] * len(tweets)
+            scrubbed = [scrub_tweet(text, tweet_entities)
+                        for text, tweet_entities in zip(tweets['full_text'].values,
+                                                        entities)]
+            tweets['scrubbed_text'] = scrubbed
+            tweets['text_hash'] = [text_hash(text) for text in scrubbed]
         return tweets
 
-def scrub_tweet(tweet):
-    remaining_words = compiled_scrub_pattern.findall(tweet)
-    return ' '.join(remaining_words)
+def scrub_tweet(tweet, entities=None):
+    """
+    Args:
+        tweet(str): full_text of a tweet
+        entities(dict): the tweet's entities; without them mentions, hashtags
+            and urls are found with a regex instead
 
+    Returns:
+        str: text to score
+    """
+    # entity offsets count characters of the unescaped text, while full_text
+    # comes with &, < and > escaped
+    tweet = html.unescape(tweet)
+    if isinstance(entities, dict):
+        spans = sorted(tuple(entity['indices'])
+                       for kind in removed_entities
+                       for entity in entities.get(kind) or ())
+        pieces = []
+        position = 0
+        for begin, end in spans:
+            if begin > position:
+                pieces.append(tweet[position:begin])
+            position = max(position, end)
+        pieces.append(tweet[position:])
+        tweet = ' '.join(pieces)
+    else:
+        tweet = fallback_scrub_pattern.sub(' ', tweet)
+    return ' '.join(tweet.split())[:max_text_length]
@@ -0,0 +1,41 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+levels = OrderedDict([('Low', 'LOW_LEVEL'),
+                      ('Medium', 'MED_LEVEL'),
+                      ('High', 'HI_LEVEL')])
+
+
+def make_views(tweets_df):
+    """
+    Summaries the figure callbacks draw from, computed once per lookup so
+    rendering doesn't depend on how many tweets were collected.
+
+    Args:
+        tweets_df(DataFrame): scored and categorized tweets, newest first
+
+    Returns:
+        dict: level counts, first/last display times, the toxicity series
+        as a float32 array (NaN where unscored), creation times as int64
+        seconds since the epoch and row indexes per level, both newest first
+        and most toxic first (unscored last)
+    """
+    toxicity = tweets_df['TOXICITY_score'].values.astype(np.float32)
+    level_rows = OrderedDict(
+        (name, np.flatnonzero(tweets_df[col].values).astype(np.int32))
+        for name, col in levels.items())
+    level_rows_by_toxicity = OrderedDict(
+        (name, rows[np.argsort(-toxicity[rows], kind='mergesort')])
+        for name, rows in level_rows.items())
+    return {
+        'size': len(tweets_df),
+        'counts': OrderedDict((name, len(rows)) for name, rows in level_rows.items()),
+        'begin_date': tweets_df['display_time'].iloc[-1],
+        'end_date': tweets_df['display_time'].iloc[0],
+        'toxicity': toxicity,
+        'created': tweets_df['created'].values.astype('datetime64[s]').astype(np.int64),
+        'level_rows': level_rows,
+        'level_rows_by_toxicity': level_rows_by_toxicity,
+    }
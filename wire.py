@@ -0,0 +1,54 @@
+"""
+What the browser receives from the dashboard's callbacks.
+
+The signal div only carries a dataset key; every figure and table is built
+on the server from the dataset store, and per tweet the browser is only
+sent the table's `table_columns` and the toxicity graph's
+`compact.point_fields`.
+Numbers are rounded before they are sent, since a float32 score turned into
+json is about a dozen characters longer than the score it shows.  Responses
+are gzipped (flask_compress in app.py); their sizes are observed as
+dash_response_bytes per callback output and added up per dataset (see
+DatasetStore.add_sent).
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from compact import point_fields
+
+
+# table header -> dataset column
+table_columns = OrderedDict([('text', 'full_text'),
+                             ('author', 'screen_name'),
+                             ('time', 'display_time'),
+                             ('toxicity', 'TOXICITY_score')])
+
+
+def customdata(details):
+    """
+    Args:
+        details(dict): point details from DatasetStore.get_points; the
+            status id is a string since it doesn't fit in a javascript number
+
+    Returns:
+        list: [screen name, status id, text snippet, whether it was cut] per
+        point
+    """
+    return [list(point) for point in zip(*(details[field].tolist()
+                                           for field in point_fields))]
+
+
+def numbers(values, decimals=1):
+    """
+    Args:
+        values(ndarray): numbers to send
+        decimals(int): decimals to keep
+
+    Returns:
+        list: values rounded, as ints where whole, None where NaN
+    """
+    values = np.round(np.asarray(values, dtype=np.float64), decimals)
+    whole = values == np.floor(values)
+    return [None if np.isnan(v) else int(v) if w else v
+            for v, w in zip(values.tolist(), whole.tolist())]